@@ -1,17 +1,36 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, Body
+from fastapi import FastAPI, Depends, status, Request, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
 from typing import List, Optional, Dict, Any
-from pydantic import BaseModel, EmailStr, validator
 import os
-import uuid
-from sqlalchemy import create_engine, text
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import bindparam, create_engine, event, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
-import pymysql
-from datetime import datetime, date, time
+from datetime import datetime, date, time, timedelta, timezone
 from dotenv import load_dotenv
-import json
+import asyncio
+import contextvars
+import functools
+import random
+import re
+import threading
+import itertools
+from bisect import bisect_left
+import gzip
+import hashlib
+import hmac
+import math
+import sqlite3
+import time as clock
+from collections import deque
+from email.utils import format_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Load environment variables
 load_dotenv()
@@ -24,9 +43,30 @@ MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE", "driving_school_db")
 
 SQLALCHEMY_DATABASE_URL = f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{MYSQL_DATABASE}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Connection pool sizing: DB_MAX_CONNECTIONS is the budget this server may
+# open to each database server, split between the WEB_CONCURRENCY worker
+# processes. Every worker needs at least two connections.
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", "40"))
+DB_CONNECTIONS_PER_WORKER = DB_MAX_CONNECTIONS // WEB_CONCURRENCY
+
+if DB_CONNECTIONS_PER_WORKER < 2:
+    raise RuntimeError(
+        f"DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS} cannot give {WEB_CONCURRENCY} workers "
+        f"two connections each; lower WEB_CONCURRENCY or raise DB_MAX_CONNECTIONS"
+    )
+
+def engine_options():
+    pool_size = max(1, DB_CONNECTIONS_PER_WORKER // 2)
+    return {
+        "pool_size": pool_size,
+        "max_overflow": DB_CONNECTIONS_PER_WORKER - pool_size,
+        "pool_recycle": 3600,
+        "pool_pre_ping": True
+    }
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
 
 app = FastAPI()
 
@@ -39,6 +79,439 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Optional read replicas, as comma-separated SQLAlchemy URLs
+MYSQL_REPLICA_URLS = [url.strip() for url in os.environ.get("MYSQL_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_HEALTH_CHECK_SECONDS = float(os.environ.get("REPLICA_HEALTH_CHECK_SECONDS", "10"))
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "5"))
+REPLICA_CONNECT_TIMEOUT_SECONDS = int(os.environ.get("REPLICA_CONNECT_TIMEOUT_SECONDS", "2"))
+
+class ReplicaRouter:
+    """Hand out sessions on read replicas in round-robin order.
+
+    Replicas are pinged by a background thread every
+    REPLICA_HEALTH_CHECK_SECONDS, so requests never wait on a health check;
+    unhealthy replicas are skipped, and the primary is used when none is
+    healthy.
+    """
+
+    def __init__(self, urls):
+        self.replicas = []
+        for url in urls:
+            replica_engine = create_engine(
+                url,
+                connect_args={"connect_timeout": REPLICA_CONNECT_TIMEOUT_SECONDS},
+                **engine_options()
+            )
+            self.replicas.append({
+                "engine": replica_engine,
+                "sessionmaker": sessionmaker(autocommit=False, autoflush=False, bind=replica_engine),
+                "healthy": True
+            })
+        self.position = itertools.count()
+
+    def check_health(self):
+        for replica in self.replicas:
+            try:
+                with replica["engine"].connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                replica["healthy"] = True
+            except Exception as e:
+                if replica["healthy"]:
+                    print(f"Read replica unavailable, routing reads elsewhere: {e}")
+                replica["healthy"] = False
+
+    def run_health_checks(self):
+        while not _shutting_down.wait(REPLICA_HEALTH_CHECK_SECONDS):
+            self.check_health()
+
+    def pick_sessionmaker(self):
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self.position) % len(self.replicas)]
+            if replica["healthy"]:
+                return replica["sessionmaker"]
+        return SessionLocal
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica["engine"].dispose()
+
+replica_router = ReplicaRouter(MYSQL_REPLICA_URLS) if MYSQL_REPLICA_URLS else None
+
+# Client identification: behind the local nginx the peer is the proxy, so
+# the client address comes from the headers it sets
+TRUSTED_PROXIES = {"127.0.0.1", "::1"}
+
+def client_ip(request):
+    host = request.client.host if request.client else None
+    if host in TRUSTED_PROXIES:
+        forwarded = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for", "").split(",")[0].strip()
+        if forwarded:
+            return forwarded
+    return host
+
+# Read-your-writes: clients and users who just wrote read from the primary
+# until their writes have had time to reach the replicas. Worker processes
+# share the markers through READ_YOUR_WRITES_STORE, a SQLite file, since a
+# client's next request is usually served by another worker.
+READ_YOUR_WRITES_STORE = os.environ.get("READ_YOUR_WRITES_STORE", "")
+
+class RecentWriters:
+    """In-process read-your-writes markers, one per client or user key."""
+
+    def __init__(self, ttl_seconds):
+        self.ttl = ttl_seconds
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def mark(self, keys):
+        now = clock.time()
+        with self.lock:
+            # Expired markers are dropped on every write so the map only
+            # holds the writers of the last ttl seconds
+            for key in [key for key, expires_at in self.expires.items() if expires_at <= now]:
+                del self.expires[key]
+            for key in keys:
+                self.expires[key] = now + self.ttl
+
+    def any_recent(self, keys):
+        now = clock.time()
+        with self.lock:
+            return any(self.expires.get(key, 0) > now for key in keys)
+
+class SharedRecentWriters(RecentWriters):
+    """Read-your-writes markers kept in a SQLite file so every worker sees them."""
+
+    def __init__(self, ttl_seconds, path):
+        super().__init__(ttl_seconds)
+        self.connection = sqlite3.connect(path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS recent_writes (key TEXT PRIMARY KEY, expires_at REAL)"
+        )
+
+    def mark(self, keys):
+        now = clock.time()
+        with self.lock:
+            try:
+                self.connection.execute("DELETE FROM recent_writes WHERE expires_at <= ?", (now,))
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO recent_writes (key, expires_at) VALUES (?, ?)",
+                    [(key, now + self.ttl) for key in keys]
+                )
+            except sqlite3.Error as e:
+                print(f"Read-your-writes store error: {e}")
+
+    def any_recent(self, keys):
+        if not keys:
+            return False
+        placeholders = ", ".join("?" for _ in keys)
+        with self.lock:
+            try:
+                row = self.connection.execute(
+                    f"SELECT 1 FROM recent_writes WHERE key IN ({placeholders}) AND expires_at > ? LIMIT 1",
+                    (*keys, clock.time())
+                ).fetchone()
+            except sqlite3.Error as e:
+                # Without the markers, reading from the primary is the safe choice
+                print(f"Read-your-writes store error, reading from the primary: {e}")
+                return True
+        return row is not None
+
+def create_recent_writers():
+    if READ_YOUR_WRITES_STORE:
+        return SharedRecentWriters(READ_YOUR_WRITES_SECONDS, READ_YOUR_WRITES_STORE)
+    return RecentWriters(READ_YOUR_WRITES_SECONDS)
+
+recent_writers = create_recent_writers() if replica_router is not None else None
+
+def recent_writer_keys(request):
+    keys = []
+    ip = client_ip(request)
+    if ip:
+        keys.append(f"client:{ip}")
+    user_id = request.path_params.get("user_id")
+    if user_id is not None:
+        keys.append(f"user:{user_id}")
+    return keys
+
+def mark_recent_write(request, user_id=None):
+    if recent_writers is None:
+        return
+    keys = recent_writer_keys(request)
+    if user_id is not None:
+        keys.append(f"user:{user_id}")
+    recent_writers.mark(keys)
+
+def wrote_recently(request):
+    return recent_writers is not None and recent_writers.any_recent(recent_writer_keys(request))
+
+def read_sessionmaker(request):
+    if replica_router is None or wrote_recently(request):
+        return SessionLocal
+    return replica_router.pick_sessionmaker()
+
+# Tables owned by this service, created on startup if missing
+SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS course_session_teachers (
+        course_session_id INT NOT NULL PRIMARY KEY,
+        teacher_id INT NOT NULL,
+        assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_course_session_teachers_teacher (teacher_id)
+    )
+    """,
+    # Archive tables share the structure and indexes of the live tables
+    "CREATE TABLE IF NOT EXISTS course_sessions_archive LIKE course_sessions",
+    "CREATE TABLE IF NOT EXISTS session_enrollments_archive LIKE session_enrollments",
+    "CREATE TABLE IF NOT EXISTS course_session_teachers_archive LIKE course_session_teachers",
+    "CREATE TABLE IF NOT EXISTS reviews_archive LIKE reviews",
+]
+
+def ensure_schema():
+    with engine.begin() as connection:
+        for statement in SCHEMA_STATEMENTS:
+            connection.execute(text(statement))
+
+# Response compression
+# Responses with a known length of at least COMPRESSION_MIN_SIZE bytes are
+# compressed with brotli (when installed) or gzip, following Accept-Encoding.
+# Streamed responses such as the calendar feed are passed through untouched.
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+_compression_stats = {"responses": 0, "bytes_in": 0, "bytes_out": 0, "bytes_saved": 0}
+_compression_stats_lock = threading.Lock()
+
+def negotiate_encoding(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header, or None."""
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[coding.strip().lower()] = quality
+    
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    candidates = [c for c in candidates if weights.get(c, weights.get("*", 0.0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: weights.get(c, weights.get("*", 0.0)))
+
+def compress_body(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+@app.middleware("http")
+async def compress_response(request: Request, call_next):
+    response = await call_next(request)
+    
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+    content_length = response.headers.get("content-length")
+    if (
+        encoding is None
+        or content_length is None
+        or int(content_length) < COMPRESSION_MIN_SIZE
+        or "content-encoding" in response.headers
+        or not response.headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+    ):
+        return response
+    
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    compressed = compress_body(body, encoding)
+    
+    async def send_body(content):
+        yield content
+    
+    if len(compressed) >= len(body):
+        response.body_iterator = send_body(body)
+        return response
+    
+    with _compression_stats_lock:
+        _compression_stats["responses"] += 1
+        _compression_stats["bytes_in"] += len(body)
+        _compression_stats["bytes_out"] += len(compressed)
+        _compression_stats["bytes_saved"] += len(body) - len(compressed)
+    
+    response.headers["content-encoding"] = encoding
+    response.headers["content-length"] = str(len(compressed))
+    vary = response.headers.get("vary")
+    response.headers["vary"] = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+    response.body_iterator = send_body(compressed)
+    return response
+
+# Request profiling
+# Opt-in per request with an `X-Profile: 1` header from an internal client
+# (see is_internal_request), or sampled with PROFILE_SAMPLE_RATE. A profiled
+# request records its database, Python and serialization time and every
+# statement it ran, grouped by fingerprint (the statement with its
+# parameters stripped), into a ring buffer served at /api/_internal/profiles.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_BUFFER_SIZE = int(os.environ.get("PROFILE_BUFFER_SIZE", "200"))
+# Lets clients outside the host use X-Profile and read profiles by sending
+# it as X-Profile-Token; without it only requests from the host itself can
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+
+def is_internal_request(request):
+    """Whether the request comes from the host itself, not through nginx.
+
+    nginx always sets X-Real-IP, so a loopback peer without it did not
+    come through the proxy. A matching X-Profile-Token also qualifies.
+    """
+    token = request.headers.get("x-profile-token")
+    if PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    return (
+        request.client is not None
+        and request.client.host in TRUSTED_PROXIES
+        and "x-real-ip" not in request.headers
+        and "x-forwarded-for" not in request.headers
+    )
+
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+_profiles = deque(maxlen=PROFILE_BUFFER_SIZE)
+_profile_ids = itertools.count(1)
+
+def statement_fingerprint(statement):
+    """Normalize a SQL statement so that executions differing only in parameters match."""
+    normalized = re.sub(r"%\(\w+\)s|'(?:[^'\\]|\\.|'')*'|\b\d+\b", "?", statement)
+    normalized = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?+)", normalized)
+    normalized = " ".join(normalized.split())
+    return normalized, fingerprint_hash(normalized)
+
+def fingerprint_hash(value):
+    return hashlib.sha1(value.encode()).hexdigest()[:12]
+
+class RequestProfile:
+    def __init__(self, method, path):
+        self.id = next(_profile_ids)
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self.statements = []
+        self.handler_seconds = 0.0
+        self.handler_finished_at = None
+
+    def add_statement(self, statement, duration, rows):
+        self.statements.append((statement, duration, rows))
+
+    def to_dict(self, route, status_code, total_seconds, response_ready_at):
+        db_seconds = sum(duration for _, duration, _ in self.statements)
+        fingerprints = {}
+        statements = []
+        for statement, duration, rows in self.statements:
+            normalized, fingerprint = statement_fingerprint(statement)
+            summary = fingerprints.setdefault(fingerprint, {"statement": normalized, "count": 0, "duration_ms": 0.0, "rows": 0})
+            summary["count"] += 1
+            summary["duration_ms"] += duration * 1000
+            summary["rows"] += rows or 0
+            statements.append({"fingerprint": fingerprint, "duration_ms": round(duration * 1000, 3), "rows": rows})
+        
+        serialization_seconds = (
+            response_ready_at - self.handler_finished_at if self.handler_finished_at else 0.0
+        )
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": route,
+            "status_code": status_code,
+            "started_at": self.started_at.isoformat(),
+            "total_ms": round(total_seconds * 1000, 3),
+            "db_ms": round(db_seconds * 1000, 3),
+            "python_ms": round(max(0.0, self.handler_seconds - db_seconds) * 1000, 3),
+            "serialization_ms": round(serialization_seconds * 1000, 3),
+            "statement_count": len(self.statements),
+            "rows_fetched": sum(rows or 0 for _, _, rows in self.statements),
+            "statements": statements,
+            "fingerprints": fingerprints
+        }
+
+@event.listens_for(Engine, "before_cursor_execute")
+def profile_before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("profile_started_at", []).append(clock.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def profile_after_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    started_at = conn.info.get("profile_started_at")
+    if profile is None or not started_at:
+        return
+    duration = clock.perf_counter() - started_at.pop()
+    # Buffered cursors know their row count up front, streamed ones do not
+    rows = cursor.rowcount if cursor.description is not None and cursor.rowcount >= 0 else None
+    profile.add_statement(statement, duration, rows)
+
+def profiled_endpoint(endpoint):
+    """Wrap a route endpoint to time it when the request is profiled."""
+    def finish(profile, started_at):
+        profile.handler_finished_at = clock.perf_counter()
+        profile.handler_seconds = profile.handler_finished_at - started_at
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            profile = _current_profile.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            started_at = clock.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                finish(profile, started_at)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            profile = _current_profile.get()
+            if profile is None:
+                return endpoint(*args, **kwargs)
+            started_at = clock.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                finish(profile, started_at)
+    return wrapper
+
+class ProfilingRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled_endpoint(endpoint), **kwargs)
+
+app.router.route_class = ProfilingRoute
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    requested = (
+        request.headers.get("x-profile", "").lower() in ("1", "true")
+        and is_internal_request(request)
+    )
+    if not requested and (PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE):
+        return await call_next(request)
+    
+    profile = RequestProfile(request.method, request.url.path)
+    token = _current_profile.set(profile)
+    started_at = clock.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _current_profile.reset(token)
+    response_ready_at = clock.perf_counter()
+    
+    route = request.scope.get("route")
+    _profiles.append(profile.to_dict(
+        route.path if route else None,
+        response.status_code,
+        response_ready_at - started_at,
+        response_ready_at
+    ))
+    response.headers["x-profile-id"] = str(profile.id)
+    return response
+
 # Database dependency
 def get_db():
     db = SessionLocal()
@@ -47,81 +520,1106 @@ def get_db():
     finally:
         db.close()
 
-# Models
-class DrivingSchoolBase(BaseModel):
-    name: str
-    address: str
-    phone: str
-    email: EmailStr
-    description: Optional[str] = None
-    state_id: int
-
-class DrivingSchoolCreate(DrivingSchoolBase):
-    pass
-
-class DrivingSchool(DrivingSchoolBase):
-    id: int
-    rating: float = 0.0
-    created_at: datetime
-
-    class Config:
-        orm_mode = True
-
-class UserBase(BaseModel):
-    username: str
-    email: EmailStr
-    first_name: str
-    last_name: str
-    phone: str
-    gender: str
-    role_id: int
-    state_id: int
-    driving_school_id: Optional[int] = None
-
-class UserCreate(UserBase):
-    password: str
-
-class User(UserBase):
-    id: int
-    created_at: datetime
-
-    class Config:
-        orm_mode = True
-
-class StateBase(BaseModel):
-    name: str
-    code: str
-
-class State(StateBase):
-    id: int
-
-    class Config:
-        orm_mode = True
-
-class CourseBase(BaseModel):
-    name: str
-    description: str
-    type: str
-    sequence_order: int
-
-class Course(CourseBase):
-    id: int
-
-    class Config:
-        orm_mode = True
+# Database dependency for read-only routes, served by replicas when configured
+def get_read_db(request: Request):
+    db = read_sessionmaker(request)()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Write admission control
+# Write routes are rate limited per client IP with a token bucket and, when
+# more writes are in flight than the write share of the connection pool can
+# serve plus WRITE_QUEUE_THRESHOLD waiting for it, rejected with 503 +
+# Retry-After so that reads keep the connections reserved for them. Write
+# handlers are plain functions run in the threadpool, so they wait for pool
+# connections instead of blocking the event loop.
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "30"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "10"))
+# Optional SQLite file shared by all worker processes of the host
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "")
+RATE_LIMIT_SWEEP_SECONDS = float(os.environ.get("RATE_LIMIT_SWEEP_SECONDS", "60"))
+DB_READ_RESERVED_CONNECTIONS = int(os.environ.get("DB_READ_RESERVED_CONNECTIONS", str(max(1, DB_CONNECTIONS_PER_WORKER // 4))))
+WRITE_QUEUE_THRESHOLD = int(os.environ.get("WRITE_QUEUE_THRESHOLD", "10"))
+WRITE_RETRY_AFTER_SECONDS = int(os.environ.get("WRITE_RETRY_AFTER_SECONDS", "2"))
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code, message, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+class TokenBuckets:
+    """In-process token buckets, one per client key.
+
+    Buckets that have refilled to `burst` are indistinguishable from new
+    ones, so they are dropped every RATE_LIMIT_SWEEP_SECONDS to keep memory
+    bounded by the number of recently active clients.
+    """
+
+    def __init__(self, rate_per_second, burst):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept_at = clock.time()
+
+    def refill(self, tokens, updated_at, now):
+        return min(self.burst, tokens + (now - updated_at) * self.rate)
+
+    def sweep_due(self, now):
+        if now - self.swept_at < RATE_LIMIT_SWEEP_SECONDS:
+            return False
+        self.swept_at = now
+        return True
+
+    def sweep(self, now):
+        full = [
+            key for key, (tokens, updated_at) in self.buckets.items()
+            if self.refill(tokens, updated_at, now) >= self.burst
+        ]
+        for key in full:
+            del self.buckets[key]
+
+    def take(self, key):
+        """Take a token for `key`; return 0 or the seconds until one is available."""
+        now = clock.time()
+        with self.lock:
+            if self.sweep_due(now):
+                self.sweep(now)
+            tokens, updated_at = self.buckets.get(key, (self.burst, now))
+            tokens = self.refill(tokens, updated_at, now)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+
+class SharedTokenBuckets(TokenBuckets):
+    """Token buckets kept in a SQLite file so every worker shares them."""
+
+    def __init__(self, rate_per_second, burst, path):
+        super().__init__(rate_per_second, burst)
+        self.connection = sqlite3.connect(path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS token_buckets (key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)"
+        )
+
+    def take(self, key):
+        now = clock.time()
+        with self.lock:
+            try:
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self.connection.execute(
+                        "SELECT tokens, updated_at FROM token_buckets WHERE key = ?", (key,)
+                    ).fetchone()
+                    tokens = self.refill(*row, now) if row else self.burst
+                    wait = (1 - tokens) / self.rate if tokens < 1 else 0
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO token_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                        (key, tokens if wait else tokens - 1, now)
+                    )
+                    if self.sweep_due(now):
+                        self.sweep(now)
+                    self.connection.execute("COMMIT")
+                    return wait
+                except Exception:
+                    self.connection.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                # Never turn a broken limiter store into an outage
+                print(f"Rate limit store error, allowing request: {e}")
+                return 0
+
+    def sweep(self, now):
+        self.connection.execute(
+            "DELETE FROM token_buckets WHERE tokens + (? - updated_at) * ? >= ?",
+            (now, self.rate, self.burst)
+        )
+
+def create_rate_limiter():
+    rate = RATE_LIMIT_PER_MINUTE / 60
+    if RATE_LIMIT_STORE:
+        return SharedTokenBuckets(rate, RATE_LIMIT_BURST, RATE_LIMIT_STORE)
+    return TokenBuckets(rate, RATE_LIMIT_BURST)
+
+rate_limiter = create_rate_limiter()
+
+_writes_in_flight = 0
+_writes_in_flight_lock = threading.Lock()
+
+def write_connection_slots():
+    options = engine_options()
+    return max(1, options["pool_size"] + options["max_overflow"] - DB_READ_RESERVED_CONNECTIONS)
+
+def rate_limit_key(request):
+    # Write routes carry no authenticated identity, so clients are told apart by address
+    return f"client:{client_ip(request)}"
+
+def admit_write(request: Request):
+    """Dependency of write routes applying rate limiting and load shedding."""
+    global _writes_in_flight
+    
+    retry_after = rate_limiter.take(rate_limit_key(request))
+    if retry_after:
+        raise AdmissionRejected(status.HTTP_429_TOO_MANY_REQUESTS, "Too many requests", retry_after)
+    
+    slots = write_connection_slots()
+    with _writes_in_flight_lock:
+        if _writes_in_flight - slots >= WRITE_QUEUE_THRESHOLD:
+            raise AdmissionRejected(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "Server is busy, please retry later",
+                WRITE_RETRY_AFTER_SECONDS
+            )
+        _writes_in_flight += 1
+    
+    try:
+        yield
+    finally:
+        with _writes_in_flight_lock:
+            _writes_in_flight -= 1
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"message": exc.message},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))}
+    )
+
+# Course progression
+# A course counts as completed once its enrollment is 'completed' or an exam
+# for it has been passed. Courses are grouped into stages by sequence_order;
+# a stage is only open once every course of the previous stages is completed.
+PROGRESSION_COURSE_COLUMNS = """
+    c.id, c.name, c.type, c.sequence_order,
+    MAX(e.id IS NOT NULL) AS enrolled,
+    MAX(e.status = 'completed' OR x.status = 'passed') AS completed
+"""
+
+def build_progression(course_rows):
+    """Compute stage, eligible courses and next course from per-course rows.
+
+    Each row is (course_id, name, type, sequence_order, enrolled, completed),
+    ordered by sequence_order.
+    """
+    stages = []
+    for row in course_rows:
+        course = {
+            "id": row[0],
+            "name": row[1],
+            "type": row[2],
+            "sequence_order": row[3],
+            "enrolled": bool(row[4]),
+            "completed": bool(row[5])
+        }
+        if not stages or stages[-1][0] != course["sequence_order"]:
+            stages.append((course["sequence_order"], []))
+        stages[-1][1].append(course)
+
+    current_stage = 0
+    completed_courses = []
+    eligible_courses = []
+    for sequence_order, courses in stages:
+        completed_courses.extend(c["id"] for c in courses if c["completed"])
+        pending = [c for c in courses if not c["completed"]]
+        if pending:
+            eligible_courses = pending
+            break
+        current_stage = sequence_order
+
+    return {
+        "current_stage": current_stage,
+        "completed_courses": completed_courses,
+        "eligible_courses": eligible_courses,
+        "next_course": eligible_courses[0] if eligible_courses else None
+    }
+
+def get_student_progression(db, user_id):
+    """Compute the progression of a single student in one query."""
+    result = db.execute(
+        text(f"""
+            SELECT {PROGRESSION_COURSE_COLUMNS}
+            FROM courses c
+            LEFT JOIN enrollments e ON e.course_id = c.id AND e.user_id = :user_id
+            LEFT JOIN exams x ON x.course_id = c.id AND x.user_id = :user_id
+            GROUP BY c.id, c.name, c.type, c.sequence_order
+            ORDER BY c.sequence_order, c.id
+        """),
+        {"user_id": user_id}
+    )
+    progression = build_progression(result)
+    progression["user_id"] = user_id
+    return progression
+
+def get_school_progression(db, school_id):
+    """Compute the progression of every student of a school in one query."""
+    result = db.execute(
+        text(f"""
+            SELECT s.user_id, {PROGRESSION_COURSE_COLUMNS}
+            FROM (
+                SELECT DISTINCT user_id FROM enrollments
+                WHERE driving_school_id = :school_id
+            ) s
+            CROSS JOIN courses c
+            LEFT JOIN enrollments e ON e.course_id = c.id AND e.user_id = s.user_id
+            LEFT JOIN exams x ON x.course_id = c.id AND x.user_id = s.user_id
+            GROUP BY s.user_id, c.id, c.name, c.type, c.sequence_order
+            ORDER BY s.user_id, c.sequence_order, c.id
+        """),
+        {"school_id": school_id}
+    )
+
+    rows_by_user = {}
+    for row in result:
+        rows_by_user.setdefault(row[0], []).append(row[1:])
+
+    progressions = []
+    for user_id, course_rows in rows_by_user.items():
+        progression = build_progression(course_rows)
+        progression["user_id"] = user_id
+        progressions.append(progression)
+    return progressions
+
+# Teacher scheduling
+SCHEDULE_INDEX_TTL_SECONDS = int(os.environ.get("SCHEDULE_INDEX_TTL_SECONDS", "60"))
+
+def session_interval(session_date, start_time, end_time):
+    """Return (start, end) datetimes of a session.
+
+    MySQL TIME columns are returned as timedelta by pymysql, while parsed
+    request values are datetime.time.
+    """
+    def at(value):
+        if isinstance(value, timedelta):
+            return datetime.combine(session_date, time.min) + value
+        return datetime.combine(session_date, value)
+    return at(start_time), at(end_time)
+
+class TeacherScheduleIndex:
+    """Interval index of the upcoming sessions assigned to a school's teachers.
+
+    Used to answer availability queries; it is a per-worker cache refreshed
+    every SCHEDULE_INDEX_TTL_SECONDS, so it is not the source of truth for
+    double-booking checks.
+
+    A teacher's sessions never overlap, so their intervals sorted by start are
+    also sorted by end: the only candidate for an overlap with [start, end) is
+    the last interval starting before `end`, found by bisection.
+    """
+
+    def __init__(self, school_id, teachers):
+        self.school_id = school_id
+        self.teachers = teachers
+        self.starts = {teacher_id: [] for teacher_id in teachers}
+        self.intervals = {teacher_id: [] for teacher_id in teachers}
+        self.session_teacher = {}
+        self.loaded_at = datetime.now()
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return datetime.now() - self.loaded_at > timedelta(seconds=SCHEDULE_INDEX_TTL_SECONDS)
+
+    def add(self, teacher_id, start, end, session_id):
+        self.remove(session_id)
+        starts = self.starts.setdefault(teacher_id, [])
+        intervals = self.intervals.setdefault(teacher_id, [])
+        position = bisect_left(starts, start)
+        starts.insert(position, start)
+        intervals.insert(position, (start, end, session_id))
+        self.session_teacher[session_id] = teacher_id
+
+    def remove(self, session_id):
+        teacher_id = self.session_teacher.pop(session_id, None)
+        if teacher_id is None:
+            return
+        intervals = self.intervals[teacher_id]
+        for position, interval in enumerate(intervals):
+            if interval[2] == session_id:
+                del intervals[position]
+                del self.starts[teacher_id][position]
+                break
+
+    def find_conflict(self, teacher_id, start, end, ignore_session_id=None):
+        """Return the id of a session of the teacher overlapping [start, end)."""
+        starts = self.starts.get(teacher_id, [])
+        intervals = self.intervals.get(teacher_id, [])
+        position = bisect_left(starts, end) - 1
+        while position >= 0:
+            _, interval_end, session_id = intervals[position]
+            if session_id != ignore_session_id:
+                return session_id if interval_end > start else None
+            position -= 1
+        return None
+
+    def free_teachers(self, start, end):
+        return [
+            teacher for teacher_id, teacher in self.teachers.items()
+            if self.find_conflict(teacher_id, start, end) is None
+        ]
+
+_schedule_indexes = {}
+_schedule_indexes_lock = threading.Lock()
+
+def load_schedule_index(db, school_id):
+    teachers_result = db.execute(
+        text("""
+            SELECT id, first_name, last_name, gender
+            FROM users
+            WHERE role_id = 2 AND driving_school_id = :school_id
+        """),
+        {"school_id": school_id}
+    )
+    teachers = {
+        row[0]: {
+            "id": row[0],
+            "first_name": row[1],
+            "last_name": row[2],
+            "gender": row[3]
+        } for row in teachers_result
+    }
+    index = TeacherScheduleIndex(school_id, teachers)
+
+    sessions_result = db.execute(
+        text("""
+            SELECT cs.id, cs.session_date, cs.start_time, cs.end_time, t.teacher_id
+            FROM course_session_teachers t
+            JOIN course_sessions cs ON t.course_session_id = cs.id
+            WHERE cs.driving_school_id = :school_id
+            AND cs.session_date >= CURDATE()
+        """),
+        {"school_id": school_id}
+    )
+    for row in sessions_result:
+        start, end = session_interval(row[1], row[2], row[3])
+        index.add(row[4], start, end, row[0])
+    return index
+
+def get_schedule_index(db, school_id):
+    """Return the cached schedule index of a school, reloading it when stale.
+
+    The index only serves availability queries; assignments are checked by
+    the database, see find_teacher_conflict.
+    """
+    with _schedule_indexes_lock:
+        index = _schedule_indexes.get(school_id)
+    if index is None or index.is_stale():
+        # Load outside the global lock so one school's reload does not block others
+        index = load_schedule_index(db, school_id)
+        with _schedule_indexes_lock:
+            _schedule_indexes[school_id] = index
+    return index
+
+def record_teacher_assignment(school_id, teacher_id, start, end, session_id):
+    """Apply an assignment to this worker's cached index of the school, if any."""
+    with _schedule_indexes_lock:
+        index = _schedule_indexes.get(school_id)
+    if index is not None:
+        with index.lock:
+            index.add(teacher_id, start, end, session_id)
+
+def find_teacher_conflict(db, teacher_id, session_id, session_date, start_time, end_time):
+    """Return the id of a session of the teacher overlapping the given slot.
+
+    Must run in the assignment transaction after lock_teacher, so that
+    concurrent assignments of the same teacher, from any worker, are
+    checked one after the other.
+    """
+    row = db.execute(
+        text("""
+            SELECT cs.id
+            FROM course_session_teachers t
+            JOIN course_sessions cs ON t.course_session_id = cs.id
+            WHERE t.teacher_id = :teacher_id
+            AND cs.id <> :session_id
+            AND cs.session_date = :session_date
+            AND cs.start_time < :end_time
+            AND cs.end_time > :start_time
+            LIMIT 1
+        """),
+        {
+            "teacher_id": teacher_id,
+            "session_id": session_id,
+            "session_date": session_date,
+            "start_time": start_time,
+            "end_time": end_time
+        }
+    ).fetchone()
+    return row[0] if row else None
+
+def lock_teacher(db, teacher_id, school_id):
+    """Lock the teacher's user row for the rest of the transaction; False if not a teacher of the school."""
+    row = db.execute(
+        text("""
+            SELECT id FROM users
+            WHERE id = :teacher_id AND role_id = 2 AND driving_school_id = :school_id
+            FOR UPDATE
+        """),
+        {"teacher_id": teacher_id, "school_id": school_id}
+    ).fetchone()
+    return row is not None
+
+# Exams
+EXAM_PASS_SCORE = float(os.environ.get("EXAM_PASS_SCORE", "50"))
+EXAM_RESULTS_MAX_BATCH = int(os.environ.get("EXAM_RESULTS_MAX_BATCH", "1000"))
+EXAM_RESULTS_CHUNK_SIZE = 500
+
+def apply_exam_results(db, results):
+    """Write (exam_id, score, status) tuples with one multi-row UPDATE per chunk."""
+    for offset in range(0, len(results), EXAM_RESULTS_CHUNK_SIZE):
+        chunk = results[offset:offset + EXAM_RESULTS_CHUNK_SIZE]
+        params = {}
+        score_cases = []
+        status_cases = []
+        for i, (exam_id, score, exam_status) in enumerate(chunk):
+            params[f"id_{i}"] = exam_id
+            params[f"score_{i}"] = score
+            params[f"status_{i}"] = exam_status
+            score_cases.append(f"WHEN :id_{i} THEN :score_{i}")
+            status_cases.append(f"WHEN :id_{i} THEN :status_{i}")
+        ids = [exam_id for exam_id, _, _ in chunk]
+        
+        db.execute(
+            text(f"""
+                UPDATE exams
+                SET score = CASE id {' '.join(score_cases)} END,
+                    status = CASE id {' '.join(status_cases)} END
+                WHERE id IN :ids
+            """).bindparams(bindparam("ids", expanding=True)),
+            {**params, "ids": ids}
+        )
+        
+        # Passing the exam completes the matching course enrollment
+        db.execute(
+            text("""
+                UPDATE enrollments e
+                JOIN exams x ON x.user_id = e.user_id AND x.course_id = e.course_id
+                SET e.status = 'completed'
+                WHERE x.id IN :ids AND x.status = 'passed'
+            """).bindparams(bindparam("ids", expanding=True)),
+            {"ids": ids}
+        )
+
+# Student calendar feed
+# Calendar apps poll the feed often, so every request first runs a cheap
+# validator query over the student's upcoming sessions; the full feed is
+# only generated when that validator changed. The validator checksums every
+# field the feed renders, so edits to a session or its school change it too.
+def get_calendar_version(db, user_id):
+    """Return (etag, last_modified) of a student's upcoming sessions.
+
+    last_modified is the latest payment or teacher assignment timestamp, or
+    None when there is none.
+    """
+    row = db.execute(
+        text("""
+            SELECT COUNT(*),
+                   BIT_XOR(CRC32(CONCAT_WS('|', se.id, se.payment_status,
+                       cs.id, cs.session_date, cs.start_time, cs.end_time, cs.zoom_link,
+                       c.name, ds.name, ds.address))),
+                   MAX(GREATEST(COALESCE(se.payment_date, '1970-01-01'),
+                                COALESCE(t.assigned_at, '1970-01-01')))
+            FROM session_enrollments se
+            JOIN course_sessions cs ON se.course_session_id = cs.id
+            JOIN courses c ON cs.course_id = c.id
+            JOIN driving_schools ds ON cs.driving_school_id = ds.id
+            LEFT JOIN course_session_teachers t ON t.course_session_id = cs.id
+            WHERE se.user_id = :user_id
+            AND cs.session_date >= CURDATE()
+        """),
+        {"user_id": user_id}
+    ).fetchone()
+    
+    validator = f"{user_id}:{date.today().isoformat()}:{row[0]}:{row[1]}"
+    etag = '"' + hashlib.sha1(validator.encode()).hexdigest() + '"'
+    
+    last_modified = row[2]
+    if isinstance(last_modified, str):
+        last_modified = datetime.fromisoformat(last_modified)
+    if last_modified is not None and last_modified.year <= 1970:
+        last_modified = None
+    return etag, last_modified
+
+def is_calendar_unchanged(request, etag):
+    """Whether the client's If-None-Match matches the current ETag.
+
+    If-Modified-Since alone is not trusted: not every change that affects
+    the feed, such as a new unpaid enrollment, carries a timestamp.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
+def ics_escape(value):
+    return (str(value or "").replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+def ics_line(line):
+    """Fold a content line to 75 octets as required by RFC 5545."""
+    encoded = line.encode()
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        # Never split a multi-byte character
+        while cut and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode())
+        encoded = encoded[cut:]
+    parts.append(encoded.decode())
+    return "\r\n ".join(parts) + "\r\n"
+
+def generate_student_calendar(user_id, session_factory):
+    """Yield the iCalendar feed of a student's upcoming sessions.
+
+    Uses its own session because the request's session is closed before a
+    streaming response body is sent.
+    """
+    db = session_factory()
+    try:
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        yield ics_line("BEGIN:VCALENDAR")
+        yield ics_line("VERSION:2.0")
+        yield ics_line("PRODID:-//Driving School Management//Sessions//EN")
+        yield ics_line("CALSCALE:GREGORIAN")
+        yield ics_line("X-WR-CALNAME:Driving lessons")
+        
+        result = db.execute(
+            text("""
+                SELECT cs.id, cs.session_date, cs.start_time, cs.end_time, cs.zoom_link,
+                       c.name as course_name, ds.name as school_name, ds.address
+                FROM session_enrollments se
+                JOIN course_sessions cs ON se.course_session_id = cs.id
+                JOIN courses c ON cs.course_id = c.id
+                JOIN driving_schools ds ON cs.driving_school_id = ds.id
+                WHERE se.user_id = :user_id
+                AND cs.session_date >= CURDATE()
+                ORDER BY cs.session_date, cs.start_time
+            """).execution_options(stream_results=True),
+            {"user_id": user_id}
+        )
+        
+        for row in result:
+            start, end = session_interval(row[1], row[2], row[3])
+            yield ics_line("BEGIN:VEVENT")
+            yield ics_line(f"UID:session-{row[0]}-user-{user_id}@driving-school")
+            yield ics_line(f"DTSTAMP:{stamp}")
+            yield ics_line(f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}")
+            yield ics_line(f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}")
+            yield ics_line(f"SUMMARY:{ics_escape(row[5])} - {ics_escape(row[6])}")
+            if row[7]:
+                yield ics_line(f"LOCATION:{ics_escape(row[7])}")
+            if row[4]:
+                yield ics_line(f"URL:{row[4]}")
+            yield ics_line("END:VEVENT")
+        
+        yield ics_line("END:VCALENDAR")
+    finally:
+        db.close()
+
+# Shared read queries
+# Each fetcher takes a list of ids and reads them with one IN (...) query per
+# table, so the single-item routes and /api/batch share the same SQL.
+def fetch_states(db):
+    result = db.execute(text("SELECT id, name, code FROM states"))
+    return [{"id": row[0], "name": row[1], "code": row[2]} for row in result]
+
+def fetch_courses(db):
+    result = db.execute(text("SELECT id, name, description, type, sequence_order FROM courses"))
+    return [
+        {
+            "id": row[0], 
+            "name": row[1], 
+            "description": row[2],
+            "type": row[3],
+            "sequence_order": row[4]
+        } for row in result
+    ]
+
+def price_value(value):
+    return float(value) if value else 0.0
+
+def image_list(value):
+    return value.split(',') if value else []
+
+# Columns of the school list, in response order: field -> (SQL expression, converter)
+SCHOOL_LIST_FIELDS = {
+    "id": ("d.id", None),
+    "name": ("d.name", None),
+    "address": ("d.address", None),
+    "phone": ("d.phone", None),
+    "email": ("d.email", None),
+    "description": ("d.description", None),
+    "rating": ("d.rating", float),
+    "state_name": ("s.name", None),
+    "theory_course_price": ("d.theory_course_price", price_value),
+    "parking_course_price": ("d.parking_course_price", price_value),
+    "road_course_price": ("d.road_course_price", price_value),
+    "full_package_price": ("d.full_package_price", price_value),
+    "images": ("d.images", image_list)
+}
+
+def parse_school_fields(fields):
+    """Turn a `fields` parameter, comma-separated or a list, into a tuple of school list fields.
+
+    Returns None when all fields are requested. `id` is always included.
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        raise ValueError("fields must be a comma-separated string or a list of names")
+    requested = {field.strip() for field in fields if field.strip()}
+    unknown = requested - set(SCHOOL_LIST_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    requested.add("id")
+    return tuple(field for field in SCHOOL_LIST_FIELDS if field in requested)
+
+def fetch_schools_by_state(db, state_ids, fields=None):
+    """Return {state_id: [school, ...]} for the given states.
+
+    Only the columns of `fields` are selected, and states are only joined
+    when state_name is requested.
+    """
+    fields = fields or tuple(SCHOOL_LIST_FIELDS)
+    columns = ", ".join(SCHOOL_LIST_FIELDS[field][0] for field in fields)
+    join = "JOIN states s ON d.state_id = s.id" if "state_name" in fields else ""
+    result = db.execute(
+        text(f"""
+            SELECT d.state_id, {columns}
+            FROM driving_schools d 
+            {join}
+            WHERE d.state_id IN :state_ids
+        """).bindparams(bindparam("state_ids", expanding=True)),
+        {"state_ids": list(state_ids)}
+    )
+    
+    converters = [SCHOOL_LIST_FIELDS[field][1] for field in fields]
+    schools = {state_id: [] for state_id in state_ids}
+    for row in result:
+        schools[row[0]].append({
+            field: convert(value) if convert else value
+            for field, convert, value in zip(fields, converters, row[1:])
+        })
+    return schools
+
+def fetch_school_details(db, school_ids):
+    """Return {school_id: school} with teachers and reviews; unknown ids are missing."""
+    # Get school basic info
+    school_result = db.execute(
+        text("""
+            SELECT d.id, d.name, d.address, d.phone, d.email, 
+                   d.description, d.rating, s.name as state_name,
+                   d.theory_course_price, d.parking_course_price, 
+                   d.road_course_price, d.full_package_price, d.website, d.images
+            FROM driving_schools d 
+            JOIN states s ON d.state_id = s.id 
+            WHERE d.id IN :school_ids
+        """).bindparams(bindparam("school_ids", expanding=True)),
+        {"school_ids": list(school_ids)}
+    )
+    
+    schools = {}
+    for school_row in school_result:
+        images = school_row[13].split(',') if school_row[13] else []
+        
+        schools[school_row[0]] = {
+            "id": school_row[0],
+            "name": school_row[1],
+            "address": school_row[2],
+            "phone": school_row[3],
+            "email": school_row[4],
+            "description": school_row[5],
+            "rating": float(school_row[6]),
+            "state_name": school_row[7],
+            "theory_course_price": float(school_row[8]) if school_row[8] else 0.0,
+            "parking_course_price": float(school_row[9]) if school_row[9] else 0.0,
+            "road_course_price": float(school_row[10]) if school_row[10] else 0.0,
+            "full_package_price": float(school_row[11]) if school_row[11] else 0.0,
+            "website": school_row[12],
+            "images": images,
+            "teachers": [],
+            "reviews": []
+        }
+    
+    if not schools:
+        return schools
+    
+    # Get teachers
+    teachers_result = db.execute(
+        text("""
+            SELECT id, first_name, last_name, gender, driving_school_id
+            FROM users 
+            WHERE role_id = 2 AND driving_school_id IN :school_ids
+        """).bindparams(bindparam("school_ids", expanding=True)),
+        {"school_ids": list(schools)}
+    )
+    
+    for row in teachers_result:
+        schools[row[4]]["teachers"].append({
+            "id": row[0],
+            "first_name": row[1],
+            "last_name": row[2],
+            "gender": row[3]
+        })
+    
+    # Get reviews, including the archived ones
+    reviews_result = db.execute(
+        text("""
+            SELECT r.id, r.rating, r.comment, r.created_at,
+                   u.first_name, u.last_name, r.driving_school_id
+            FROM reviews r
+            JOIN users u ON r.user_id = u.id
+            WHERE r.driving_school_id IN :school_ids
+            UNION ALL
+            SELECT r.id, r.rating, r.comment, r.created_at,
+                   u.first_name, u.last_name, r.driving_school_id
+            FROM reviews_archive r
+            JOIN users u ON r.user_id = u.id
+            WHERE r.driving_school_id IN :school_ids
+            ORDER BY created_at DESC
+        """).bindparams(bindparam("school_ids", expanding=True)),
+        {"school_ids": list(schools)}
+    )
+    
+    for row in reviews_result:
+        schools[row[6]]["reviews"].append({
+            "id": row[0],
+            "rating": row[1],
+            "comment": row[2],
+            "created_at": row[3].isoformat() if row[3] else None,
+            "user_name": f"{row[4]} {row[5]}"
+        })
+    
+    return schools
+
+def fetch_course_sessions(db, school_id, course_ids):
+    """Return {course_id: [session, ...]} of a school's upcoming sessions."""
+    result = db.execute(
+        text("""
+            SELECT cs.id, cs.session_date, cs.start_time, cs.end_time, 
+                   cs.zoom_link, cs.max_participants, cs.session_type,
+                   t.teacher_id, cs.course_id
+            FROM course_sessions cs
+            LEFT JOIN course_session_teachers t ON t.course_session_id = cs.id
+            WHERE cs.driving_school_id = :school_id 
+            AND cs.course_id IN :course_ids
+            AND cs.session_date >= CURDATE()
+            ORDER BY cs.session_date, cs.start_time
+        """).bindparams(bindparam("course_ids", expanding=True)),
+        {"school_id": school_id, "course_ids": list(course_ids)}
+    )
+    
+    sessions = {course_id: [] for course_id in course_ids}
+    for row in result:
+        sessions[row[8]].append({
+            "id": row[0],
+            "session_date": row[1].isoformat() if row[1] else None,
+            "start_time": str(row[2]) if row[2] else None,
+            "end_time": str(row[3]) if row[3] else None,
+            "zoom_link": row[4],
+            "max_participants": row[5],
+            "session_type": row[6],
+            "teacher_id": row[7]
+        })
+    return sessions
+
+# Batched reads
+BATCH_MAX_OPERATIONS = int(os.environ.get("BATCH_MAX_OPERATIONS", "50"))
+# Ids one operation may ask for, bounding the size of the IN (...) lists
+BATCH_MAX_IDS = int(os.environ.get("BATCH_MAX_IDS", "100"))
+# Loaders of one batch running at once, each holding a pool connection
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", str(max(1, DB_CONNECTIONS_PER_WORKER // 4))))
+
+def batch_ids(operation, plural, singular):
+    """Read a list of ids (or a single id) from a batch operation."""
+    values = operation.get(plural)
+    if values is None and operation.get(singular) is not None:
+        values = [operation[singular]]
+    if not isinstance(values, list) or not values:
+        raise ValueError(f"Missing {plural}")
+    if len(values) > BATCH_MAX_IDS:
+        raise ValueError(f"At most {BATCH_MAX_IDS} {plural} per operation")
+    return [int(value) for value in values]
+
+def plan_batch(operations):
+    """Validate batch operations and merge them into one loader per query.
+
+    Returns (loaders, ops): loaders maps a key to a function of a session,
+    and each entry of ops is either an error or the loader keys and ids its
+    response is assembled from.
+    """
+    state_ids, school_ids, sessions_by_school = {}, set(), {}
+    ops = []
+    for position, operation in enumerate(operations):
+        op_id = operation.get("id", position) if isinstance(operation, dict) else position
+        name = operation.get("op") if isinstance(operation, dict) else None
+        try:
+            if name in ("states", "courses"):
+                ops.append({"id": op_id, "op": name})
+            elif name == "schools_by_state":
+                ids = batch_ids(operation, "state_ids", "state_id")
+                fields = parse_school_fields(operation.get("fields"))
+                state_ids.setdefault(fields, set()).update(ids)
+                ops.append({"id": op_id, "op": name, "ids": ids, "key": (name, fields)})
+            elif name == "school_details":
+                ids = batch_ids(operation, "school_ids", "school_id")
+                school_ids.update(ids)
+                ops.append({"id": op_id, "op": name, "ids": ids})
+            elif name == "course_sessions":
+                school_id = int(operation["school_id"])
+                ids = batch_ids(operation, "course_ids", "course_id")
+                sessions_by_school.setdefault(school_id, set()).update(ids)
+                ops.append({"id": op_id, "op": name, "ids": ids, "key": (name, school_id)})
+            else:
+                ops.append({"id": op_id, "op": name, "error": f"Unknown operation: {name}"})
+        except (KeyError, TypeError, ValueError) as e:
+            ops.append({"id": op_id, "op": name, "error": f"Invalid parameters: {str(e)}"})
+
+    names = {op["op"] for op in ops if "error" not in op}
+    loaders = {}
+    if "states" in names:
+        loaders["states"] = fetch_states
+    if "courses" in names:
+        loaders["courses"] = fetch_courses
+    for fields, ids in state_ids.items():
+        loaders[("schools_by_state", fields)] = (
+            lambda db, ids=sorted(ids), fields=fields: fetch_schools_by_state(db, ids, fields)
+        )
+    if school_ids:
+        loaders["school_details"] = lambda db: fetch_school_details(db, sorted(school_ids))
+    for school_id, course_ids in sessions_by_school.items():
+        loaders[("course_sessions", school_id)] = (
+            lambda db, school_id=school_id, course_ids=sorted(course_ids):
+                fetch_course_sessions(db, school_id, course_ids)
+        )
+    return loaders, ops
+
+async def run_batch_loaders(loaders, session_factory):
+    """Run the loaders concurrently, each on its own session.
+
+    At most BATCH_MAX_CONCURRENCY loaders run at once, so one batch cannot
+    drain the connection pool.
+    """
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    def run(loader):
+        db = session_factory()
+        try:
+            return loader(db)
+        finally:
+            db.close()
+
+    async def run_bounded(loader):
+        async with semaphore:
+            return await run_in_threadpool(run, loader)
+
+    keys = list(loaders)
+    outcomes = await asyncio.gather(
+        *(run_bounded(loaders[key]) for key in keys),
+        return_exceptions=True
+    )
+    return dict(zip(keys, outcomes))
+
+def batch_result(op, loaded):
+    if "error" in op:
+        return {"id": op["id"], "op": op["op"], "status": status.HTTP_400_BAD_REQUEST, "message": op["error"]}
+
+    data = loaded[op.get("key", op["op"])]
+    if isinstance(data, Exception):
+        return {
+            "id": op["id"],
+            "op": op["op"],
+            "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+            "message": f"Database error: {str(data)}"
+        }
+
+    if "ids" in op:
+        data = {str(item_id): data.get(item_id) for item_id in op["ids"]}
+    return {"id": op["id"], "op": op["op"], "status": status.HTTP_200_OK, "data": data}
+
+# Data retention
+# Past sessions (with their enrollments and teacher assignments) and old
+# reviews are moved to the *_archive tables in small batches, pausing
+# between batches so the primary is never busy with archival for long.
+# Student history and school details read the archive tables too.
+# A MySQL named lock keeps a single run going across all workers. Runs are
+# scheduled with ARCHIVE_INTERVAL_HOURS or started by hand with
+# `python server.py archive`; archival is not exposed over HTTP.
+ARCHIVE_HORIZON_DAYS = int(os.environ.get("ARCHIVE_HORIZON_DAYS", "180"))
+REVIEW_ARCHIVE_HORIZON_DAYS = int(os.environ.get("REVIEW_ARCHIVE_HORIZON_DAYS", "730"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_PAUSE_SECONDS = float(os.environ.get("ARCHIVE_PAUSE_SECONDS", "0.5"))
+# Run archival periodically when set, 0 disables the schedule
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get("ARCHIVE_INTERVAL_HOURS", "0"))
+
+ARCHIVE_LOCK_NAME = "driving_school_archival"
+
+def move_rows(connection, table, key_column, ids):
+    """Copy rows to the archive table of `table`, then delete them.
+
+    A plain INSERT fails loudly on an id that is already archived, and the
+    delete must remove exactly the rows copied; otherwise the batch is
+    rolled back rather than losing rows.
+    """
+    params = {"ids": ids}
+    inserted = connection.execute(
+        text(f"INSERT INTO {table}_archive SELECT * FROM {table} WHERE {key_column} IN :ids")
+        .bindparams(bindparam("ids", expanding=True)),
+        params
+    ).rowcount
+    deleted = connection.execute(
+        text(f"DELETE FROM {table} WHERE {key_column} IN :ids").bindparams(bindparam("ids", expanding=True)),
+        params
+    ).rowcount
+    if deleted != inserted:
+        raise RuntimeError(f"Archived {inserted} rows of {table} but deleting removed {deleted}")
+
+def archive_sessions_batch(connection):
+    """Archive one batch of past sessions; return how many were moved."""
+    result = connection.execute(
+        text("""
+            SELECT id FROM course_sessions
+            WHERE session_date < CURDATE() - INTERVAL :days DAY
+            ORDER BY id
+            LIMIT :batch_size
+        """),
+        {"days": ARCHIVE_HORIZON_DAYS, "batch_size": ARCHIVE_BATCH_SIZE}
+    )
+    ids = [row[0] for row in result]
+    if ids:
+        move_rows(connection, "session_enrollments", "course_session_id", ids)
+        move_rows(connection, "course_session_teachers", "course_session_id", ids)
+        move_rows(connection, "course_sessions", "id", ids)
+    return len(ids)
+
+def archive_reviews_batch(connection):
+    """Archive one batch of old reviews; return how many were moved."""
+    result = connection.execute(
+        text("""
+            SELECT id FROM reviews
+            WHERE created_at < NOW() - INTERVAL :days DAY
+            ORDER BY id
+            LIMIT :batch_size
+        """),
+        {"days": REVIEW_ARCHIVE_HORIZON_DAYS, "batch_size": ARCHIVE_BATCH_SIZE}
+    )
+    ids = [row[0] for row in result]
+    if ids:
+        move_rows(connection, "reviews", "id", ids)
+    return len(ids)
+
+def run_archival():
+    """Archive everything past the horizons, one throttled batch at a time.
+
+    The named lock belongs to the MySQL connection that took it, so the
+    lock and every batch use one dedicated connection rather than pooled
+    sessions. Returns the number of sessions and reviews moved, or None
+    when another run holds the lock.
+    """
+    moved = {"sessions": 0, "reviews": 0}
+    with engine.connect() as connection:
+        locked = connection.execute(text("SELECT GET_LOCK(:name, 0)"), {"name": ARCHIVE_LOCK_NAME}).scalar()
+        connection.commit()
+        if not locked:
+            return None
+        try:
+            for counter, archive_batch in (("sessions", archive_sessions_batch), ("reviews", archive_reviews_batch)):
+                while not _shutting_down.is_set():
+                    try:
+                        count = archive_batch(connection)
+                        connection.commit()
+                    except Exception:
+                        connection.rollback()
+                        raise
+                    moved[counter] += count
+                    if count < ARCHIVE_BATCH_SIZE:
+                        break
+                    _shutting_down.wait(ARCHIVE_PAUSE_SECONDS)
+        finally:
+            connection.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": ARCHIVE_LOCK_NAME})
+            connection.commit()
+    return moved
+
+def archival_schedule():
+    _db_ready.wait()
+    while not _shutting_down.wait(ARCHIVE_INTERVAL_HOURS * 3600):
+        try:
+            moved = run_archival()
+            if moved is not None:
+                print(f"Archived {moved['sessions']} sessions and {moved['reviews']} reviews")
+        except Exception as e:
+            print(f"Archival failed: {e}")
 
 # API routes
 @app.get("/api")
 def read_root():
     return {"message": "Welcome to Driving School Management API"}
 
+# Readiness probe used by the entrypoint and load balancers
+@app.get("/api/health/ready")
+def health_ready():
+    if not _db_ready.is_set():
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "starting", "message": "Database warm-up in progress"}
+        )
+    
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        if _schema_error:
+            return {"status": "ready", "schema_error": _schema_error}
+        return {"status": "ready"}
+    except Exception as e:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "unavailable", "message": f"Database error: {str(e)}"}
+        )
+
+# Recorded request profiles, newest first
+@app.get("/api/_internal/profiles", response_model=List[Dict[str, Any]])
+def get_profiles(request: Request, route: Optional[str] = None, min_total_ms: float = 0, limit: int = 50):
+    if not is_internal_request(request):
+        return JSONResponse(
+            status_code=status.HTTP_403_FORBIDDEN,
+            content={"message": "Profiles are only available to internal clients"}
+        )
+    
+    profiles = [
+        profile for profile in reversed(_profiles)
+        if (route is None or profile["route"] == route) and profile["total_ms"] >= min_total_ms
+    ]
+    return profiles[:limit]
+
+# Internal metrics
+@app.get("/api/_internal/metrics", response_model=Dict[str, Any])
+def get_metrics(request: Request):
+    if not is_internal_request(request):
+        return JSONResponse(
+            status_code=status.HTTP_403_FORBIDDEN,
+            content={"message": "Metrics are only available to internal clients"}
+        )
+    
+    with _compression_stats_lock:
+        compression = dict(_compression_stats)
+    return {"compression": compression}
+
 # Get all states
 @app.get("/api/states", response_model=List[Dict[str, Any]])
-async def get_states(db=Depends(get_db)):
+async def get_states(db=Depends(get_read_db)):
     try:
-        result = db.execute(text("SELECT id, name, code FROM states"))
-        states = [{"id": row[0], "name": row[1], "code": row[2]} for row in result]
-        return states
+        return fetch_states(db)
     except Exception as e:
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -130,41 +1628,17 @@ async def get_states(db=Depends(get_db)):
 
 # Get schools by state
 @app.get("/api/schools/by-state/{state_id}", response_model=List[Dict[str, Any]])
-async def get_schools_by_state(state_id: int, db=Depends(get_db)):
+async def get_schools_by_state(state_id: int, fields: Optional[str] = None, db=Depends(get_read_db)):
     try:
-        result = db.execute(
-            text("""
-                SELECT d.id, d.name, d.address, d.phone, d.email, 
-                       d.description, d.rating, s.name as state_name,
-                       d.theory_course_price, d.parking_course_price, 
-                       d.road_course_price, d.full_package_price, d.images
-                FROM driving_schools d 
-                JOIN states s ON d.state_id = s.id 
-                WHERE d.state_id = :state_id
-            """),
-            {"state_id": state_id}
+        school_fields = parse_school_fields(fields)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": str(e)}
         )
-        
-        schools = []
-        for row in result:
-            images = row[12].split(',') if row[12] else []
-            schools.append({
-                "id": row[0],
-                "name": row[1],
-                "address": row[2],
-                "phone": row[3],
-                "email": row[4],
-                "description": row[5],
-                "rating": float(row[6]),
-                "state_name": row[7],
-                "theory_course_price": float(row[8]) if row[8] else 0.0,
-                "parking_course_price": float(row[9]) if row[9] else 0.0,
-                "road_course_price": float(row[10]) if row[10] else 0.0,
-                "full_package_price": float(row[11]) if row[11] else 0.0,
-                "images": images
-            })
-        
-        return schools
+    
+    try:
+        return fetch_schools_by_state(db, [state_id], school_fields)[state_id]
     except Exception as e:
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -172,8 +1646,8 @@ async def get_schools_by_state(state_id: int, db=Depends(get_db)):
         )
 
 # Register a new driving school
-@app.post("/api/schools/register", response_model=Dict[str, Any])
-async def register_school(school_data: dict = Body(...), db=Depends(get_db)):
+@app.post("/api/schools/register", response_model=Dict[str, Any], dependencies=[Depends(admit_write)])
+def register_school(school_data: dict = Body(...), db=Depends(get_db)):
     try:
         # Extract school and user data
         school_info = school_data.get("school")
@@ -244,19 +1718,9 @@ async def register_school(school_data: dict = Body(...), db=Depends(get_db)):
 
 # Get courses
 @app.get("/api/courses", response_model=List[Dict[str, Any]])
-async def get_courses(db=Depends(get_db)):
+async def get_courses(db=Depends(get_read_db)):
     try:
-        result = db.execute(text("SELECT id, name, description, type, sequence_order FROM courses"))
-        courses = [
-            {
-                "id": row[0], 
-                "name": row[1], 
-                "description": row[2],
-                "type": row[3],
-                "sequence_order": row[4]
-            } for row in result
-        ]
-        return courses
+        return fetch_courses(db)
     except Exception as e:
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -265,90 +1729,15 @@ async def get_courses(db=Depends(get_db)):
 
 # Get school details by ID
 @app.get("/api/schools/{school_id}", response_model=Dict[str, Any])
-async def get_school_details(school_id: int, db=Depends(get_db)):
+async def get_school_details(school_id: int, db=Depends(get_read_db)):
     try:
-        # Get school basic info
-        school_result = db.execute(
-            text("""
-                SELECT d.id, d.name, d.address, d.phone, d.email, 
-                       d.description, d.rating, s.name as state_name,
-                       d.theory_course_price, d.parking_course_price, 
-                       d.road_course_price, d.full_package_price, d.website, d.images
-                FROM driving_schools d 
-                JOIN states s ON d.state_id = s.id 
-                WHERE d.id = :school_id
-            """),
-            {"school_id": school_id}
-        )
-        
-        school_row = school_result.fetchone()
-        if not school_row:
+        school = fetch_school_details(db, [school_id]).get(school_id)
+        if not school:
             return JSONResponse(
                 status_code=status.HTTP_404_NOT_FOUND,
                 content={"message": "Driving school not found"}
             )
         
-        images = school_row[13].split(',') if school_row[13] else []
-        
-        school = {
-            "id": school_row[0],
-            "name": school_row[1],
-            "address": school_row[2],
-            "phone": school_row[3],
-            "email": school_row[4],
-            "description": school_row[5],
-            "rating": float(school_row[6]),
-            "state_name": school_row[7],
-            "theory_course_price": float(school_row[8]) if school_row[8] else 0.0,
-            "parking_course_price": float(school_row[9]) if school_row[9] else 0.0,
-            "road_course_price": float(school_row[10]) if school_row[10] else 0.0,
-            "full_package_price": float(school_row[11]) if school_row[11] else 0.0,
-            "website": school_row[12],
-            "images": images,
-            "teachers": [],
-            "reviews": []
-        }
-        
-        # Get teachers
-        teachers_result = db.execute(
-            text("""
-                SELECT id, first_name, last_name, gender
-                FROM users 
-                WHERE role_id = 2 AND driving_school_id = :school_id
-            """),
-            {"school_id": school_id}
-        )
-        
-        for row in teachers_result:
-            school["teachers"].append({
-                "id": row[0],
-                "first_name": row[1],
-                "last_name": row[2],
-                "gender": row[3]
-            })
-        
-        # Get reviews
-        reviews_result = db.execute(
-            text("""
-                SELECT r.id, r.rating, r.comment, r.created_at,
-                       u.first_name, u.last_name
-                FROM reviews r
-                JOIN users u ON r.user_id = u.id
-                WHERE r.driving_school_id = :school_id
-                ORDER BY r.created_at DESC
-            """),
-            {"school_id": school_id}
-        )
-        
-        for row in reviews_result:
-            school["reviews"].append({
-                "id": row[0],
-                "rating": row[1],
-                "comment": row[2],
-                "created_at": row[3].isoformat() if row[3] else None,
-                "user_name": f"{row[4]} {row[5]}"
-            })
-        
         return school
     except Exception as e:
         return JSONResponse(
@@ -356,45 +1745,41 @@ async def get_school_details(school_id: int, db=Depends(get_db)):
             content={"message": f"Database error: {str(e)}"}
         )
 
-# Get available sessions for a school and course
-@app.get("/api/schools/{school_id}/sessions/{course_id}", response_model=List[Dict[str, Any]])
-async def get_course_sessions(school_id: int, course_id: int, db=Depends(get_db)):
-    try:
-        result = db.execute(
-            text("""
-                SELECT id, session_date, start_time, end_time, 
-                       zoom_link, max_participants, session_type
-                FROM course_sessions
-                WHERE driving_school_id = :school_id 
-                AND course_id = :course_id
-                AND session_date >= CURDATE()
-                ORDER BY session_date, start_time
-            """),
-            {"school_id": school_id, "course_id": course_id}
-        )
-        
-        sessions = []
-        for row in result:
-            sessions.append({
-                "id": row[0],
-                "session_date": row[1].isoformat() if row[1] else None,
-                "start_time": str(row[2]) if row[2] else None,
-                "end_time": str(row[3]) if row[3] else None,
-                "zoom_link": row[4],
-                "max_participants": row[5],
-                "session_type": row[6]
-            })
-        
-        return sessions
+# Get available sessions for a school and course
+@app.get("/api/schools/{school_id}/sessions/{course_id}", response_model=List[Dict[str, Any]])
+async def get_course_sessions(school_id: int, course_id: int, db=Depends(get_read_db)):
+    try:
+        return fetch_course_sessions(db, school_id, [course_id])[course_id]
     except Exception as e:
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"message": f"Database error: {str(e)}"}
         )
 
+# Run several read operations in one request
+@app.post("/api/batch", response_model=Dict[str, Any])
+async def batch_read(request: Request, batch_data: dict = Body(...)):
+    operations = batch_data.get("operations")
+    if not operations or not isinstance(operations, list):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": "Missing operations"}
+        )
+    
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": f"At most {BATCH_MAX_OPERATIONS} operations can be batched per request"}
+        )
+    
+    loaders, ops = plan_batch(operations)
+    loaded = await run_batch_loaders(loaders, read_sessionmaker(request))
+    
+    return {"results": [batch_result(op, loaded) for op in ops]}
+
 # Register student and enroll in course
-@app.post("/api/enroll", response_model=Dict[str, Any])
-async def enroll_student(enrollment_data: dict = Body(...), db=Depends(get_db)):
+@app.post("/api/enroll", response_model=Dict[str, Any], dependencies=[Depends(admit_write)])
+def enroll_student(request: Request, enrollment_data: dict = Body(...), db=Depends(get_db)):
     try:
         # Extract data
         student_info = enrollment_data.get("student")
@@ -409,15 +1794,56 @@ async def enroll_student(enrollment_data: dict = Body(...), db=Depends(get_db)):
         # Start a transaction
         conn = db.connection()
         
-        # Check if user already exists
+        # Check if user already exists, locking the row so concurrent
+        # enrollments of the same student are serialized
         user_result = db.execute(
-            text("SELECT id FROM users WHERE email = :email"),
+            text("SELECT id FROM users WHERE email = :email FOR UPDATE"),
             {"email": student_info.get("email")}
         )
         
         user_row = user_result.fetchone()
         user_id = None
+
+        try:
+            course_id = int(enrollment_info.get("course_id"))
+        except (TypeError, ValueError):
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Invalid course_id"}
+            )
+        
+        # Only allow enrolling in courses of the student's current stage
+        progression = get_student_progression(db, user_row[0] if user_row else None)
+        eligible = {c["id"]: c for c in progression["eligible_courses"]}
+        if course_id not in eligible:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={
+                    "message": "Course is not available yet, previous courses must be completed first",
+                    "eligible_courses": list(eligible)
+                }
+            )
         
+        # Students already enrolled in the course keep their enrollment and
+        # may only book further sessions of it
+        session_id = enrollment_info.get("session_id")
+        enrollment_id = None
+        if eligible[course_id]["enrolled"]:
+            if not session_id:
+                return JSONResponse(
+                    status_code=status.HTTP_409_CONFLICT,
+                    content={"message": "Student is already enrolled in this course"}
+                )
+            enrollment_id = db.execute(
+                text("""
+                    SELECT id FROM enrollments
+                    WHERE user_id = :user_id AND course_id = :course_id
+                    ORDER BY id
+                    LIMIT 1
+                """),
+                {"user_id": user_row[0], "course_id": course_id}
+            ).scalar()
+
         if user_row:
             user_id = user_row[0]
         else:
@@ -445,25 +1871,24 @@ async def enroll_student(enrollment_data: dict = Body(...), db=Depends(get_db)):
         
         # Create enrollment
         driving_school_id = enrollment_info.get("driving_school_id")
-        course_id = enrollment_info.get("course_id")
-        session_id = enrollment_info.get("session_id")
         payment_amount = enrollment_info.get("payment_amount")
         
         # Create enrollment entry
-        db.execute(
-            text("""
-                INSERT INTO enrollments
-                (user_id, course_id, driving_school_id, status)
-                VALUES (:user_id, :course_id, :driving_school_id, 'pending')
-            """),
-            {
-                "user_id": user_id,
-                "course_id": course_id,
-                "driving_school_id": driving_school_id
-            }
-        )
-        
-        enrollment_id = conn.insert_id()
+        if enrollment_id is None:
+            db.execute(
+                text("""
+                    INSERT INTO enrollments
+                    (user_id, course_id, driving_school_id, status)
+                    VALUES (:user_id, :course_id, :driving_school_id, 'pending')
+                """),
+                {
+                    "user_id": user_id,
+                    "course_id": course_id,
+                    "driving_school_id": driving_school_id
+                }
+            )
+            
+            enrollment_id = conn.insert_id()
         
         # If session provided, create session enrollment
         if session_id:
@@ -485,6 +1910,7 @@ async def enroll_student(enrollment_data: dict = Body(...), db=Depends(get_db)):
             session_enrollment_id = None
         
         db.commit()
+        mark_recent_write(request, user_id)
         
         return {
             "message": "Enrollment created successfully",
@@ -501,8 +1927,8 @@ async def enroll_student(enrollment_data: dict = Body(...), db=Depends(get_db)):
         )
 
 # Complete payment for enrollment
-@app.post("/api/payments/{enrollment_id}", response_model=Dict[str, Any])
-async def complete_payment(enrollment_id: int, payment_data: dict = Body(...), db=Depends(get_db)):
+@app.post("/api/payments/{enrollment_id}", response_model=Dict[str, Any], dependencies=[Depends(admit_write)])
+def complete_payment(enrollment_id: int, request: Request, payment_data: dict = Body(...), db=Depends(get_db)):
     try:
         # In a real system, we would process payment with a payment gateway here
         
@@ -521,7 +1947,7 @@ async def complete_payment(enrollment_id: int, payment_data: dict = Body(...), d
             text("""
                 SELECT cs.session_date, cs.start_time, cs.end_time, cs.zoom_link,
                        c.name as course_name, c.type as course_type,
-                       ds.name as school_name
+                       ds.name as school_name, se.user_id
                 FROM session_enrollments se
                 JOIN course_sessions cs ON se.course_session_id = cs.id
                 JOIN courses c ON cs.course_id = c.id
@@ -534,6 +1960,7 @@ async def complete_payment(enrollment_id: int, payment_data: dict = Body(...), d
         session_row = result.fetchone()
         
         db.commit()
+        mark_recent_write(request, session_row[7] if session_row else None)
         
         if not session_row:
             return {
@@ -562,7 +1989,7 @@ async def complete_payment(enrollment_id: int, payment_data: dict = Body(...), d
 
 # Get student dashboard
 @app.get("/api/students/{user_id}/dashboard", response_model=Dict[str, Any])
-async def get_student_dashboard(user_id: int, db=Depends(get_db)):
+async def get_student_dashboard(user_id: int, db=Depends(get_read_db)):
     try:
         # Get student enrollments
         enrollments_result = db.execute(
@@ -644,32 +2071,464 @@ async def get_student_dashboard(user_id: int, db=Depends(get_db)):
                 "exam_date": row[4].isoformat() if row[4] else None
             })
         
+        progression = get_student_progression(db, user_id)
+        
         return {
             "enrollments": enrollments,
             "upcoming_sessions": upcoming_sessions,
-            "exams": exams
+            "exams": exams,
+            "progression": progression,
+            "next_course": progression["next_course"]
+        }
+    
+    except Exception as e:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+
+# iCalendar feed of a student's upcoming sessions
+@app.get("/api/students/{user_id}/calendar.ics")
+async def get_student_calendar(user_id: int, request: Request):
+    # The validator and the body must come from the same database, so both
+    # use the session factory picked once for this request
+    session_factory = read_sessionmaker(request)
+    db = session_factory()
+    try:
+        etag, last_modified = get_calendar_version(db, user_id)
+    except Exception as e:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+    finally:
+        db.close()
+    
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache"
+    }
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    
+    if is_calendar_unchanged(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    return StreamingResponse(
+        generate_student_calendar(user_id, session_factory),
+        media_type="text/calendar; charset=utf-8",
+        headers=headers
+    )
+
+# Get a student's past sessions, including archived ones
+@app.get("/api/students/{user_id}/history", response_model=List[Dict[str, Any]])
+async def get_student_history(user_id: int, db=Depends(get_read_db)):
+    try:
+        result = db.execute(
+            text("""
+                SELECT cs.id, cs.session_date, cs.start_time, cs.end_time,
+                       c.id as course_id, c.name as course_name, c.type as course_type,
+                       ds.id as school_id, ds.name as school_name,
+                       se.payment_status
+                FROM session_enrollments se
+                JOIN course_sessions cs ON se.course_session_id = cs.id
+                JOIN courses c ON cs.course_id = c.id
+                JOIN driving_schools ds ON cs.driving_school_id = ds.id
+                WHERE se.user_id = :user_id
+                AND cs.session_date < CURDATE()
+                UNION ALL
+                SELECT cs.id, cs.session_date, cs.start_time, cs.end_time,
+                       c.id as course_id, c.name as course_name, c.type as course_type,
+                       ds.id as school_id, ds.name as school_name,
+                       se.payment_status
+                FROM session_enrollments_archive se
+                JOIN course_sessions_archive cs ON se.course_session_id = cs.id
+                JOIN courses c ON cs.course_id = c.id
+                JOIN driving_schools ds ON cs.driving_school_id = ds.id
+                WHERE se.user_id = :user_id
+                ORDER BY session_date DESC, start_time DESC
+            """),
+            {"user_id": user_id}
+        )
+        
+        sessions = []
+        for row in result:
+            sessions.append({
+                "id": row[0],
+                "session_date": row[1].isoformat() if row[1] else None,
+                "start_time": str(row[2]) if row[2] else None,
+                "end_time": str(row[3]) if row[3] else None,
+                "course_id": row[4],
+                "course_name": row[5],
+                "course_type": row[6],
+                "school_id": row[7],
+                "school_name": row[8],
+                "payment_status": row[9]
+            })
+        
+        return sessions
+    except Exception as e:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+
+# Get student progression
+@app.get("/api/students/{user_id}/progression", response_model=Dict[str, Any])
+async def get_progression(user_id: int, db=Depends(get_read_db)):
+    try:
+        return get_student_progression(db, user_id)
+    except Exception as e:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+
+# Recompute progression for all students of a school
+@app.get("/api/schools/{school_id}/progression", response_model=List[Dict[str, Any]])
+async def get_school_students_progression(school_id: int, db=Depends(get_read_db)):
+    try:
+        return get_school_progression(db, school_id)
+    except Exception as e:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+
+# Assign a teacher to a course session
+@app.post("/api/sessions/{session_id}/teacher", response_model=Dict[str, Any], dependencies=[Depends(admit_write)])
+def assign_session_teacher(session_id: int, assignment_data: dict = Body(...), db=Depends(get_db)):
+    try:
+        try:
+            teacher_id = int(assignment_data.get("teacher_id"))
+        except (TypeError, ValueError):
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Missing or invalid teacher_id"}
+            )
+        
+        session_row = db.execute(
+            text("""
+                SELECT driving_school_id, session_date, start_time, end_time
+                FROM course_sessions
+                WHERE id = :session_id
+            """),
+            {"session_id": session_id}
+        ).fetchone()
+        
+        if not session_row:
+            return JSONResponse(
+                status_code=status.HTTP_404_NOT_FOUND,
+                content={"message": "Course session not found"}
+            )
+        
+        if not lock_teacher(db, teacher_id, session_row[0]):
+            db.rollback()
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Teacher does not belong to this driving school"}
+            )
+        
+        conflicting_session_id = find_teacher_conflict(
+            db, teacher_id, session_id, session_row[1], session_row[2], session_row[3]
+        )
+        if conflicting_session_id is not None:
+            db.rollback()
+            return JSONResponse(
+                status_code=status.HTTP_409_CONFLICT,
+                content={
+                    "message": "Teacher is already booked for an overlapping session",
+                    "conflicting_session_id": conflicting_session_id
+                }
+            )
+        
+        db.execute(
+            text("""
+                INSERT INTO course_session_teachers (course_session_id, teacher_id)
+                VALUES (:session_id, :teacher_id)
+                ON DUPLICATE KEY UPDATE teacher_id = VALUES(teacher_id), assigned_at = NOW()
+            """),
+            {"session_id": session_id, "teacher_id": teacher_id}
+        )
+        db.commit()
+        
+        if session_row[1] >= date.today():
+            start, end = session_interval(session_row[1], session_row[2], session_row[3])
+            record_teacher_assignment(session_row[0], teacher_id, start, end, session_id)
+        
+        return {
+            "message": "Teacher assigned successfully",
+            "session_id": session_id,
+            "teacher_id": teacher_id
+        }
+    
+    except Exception as e:
+        db.rollback()
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+
+# Get teachers of a school that are free for a time slot
+@app.get("/api/schools/{school_id}/teachers/available", response_model=List[Dict[str, Any]])
+async def get_available_teachers(school_id: int, session_date: str, start_time: str, end_time: str, db=Depends(get_db)):
+    try:
+        slot_date = date.fromisoformat(session_date)
+        start, end = session_interval(slot_date, time.fromisoformat(start_time), time.fromisoformat(end_time))
+    except ValueError:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": "Invalid session_date, start_time or end_time"}
+        )
+    
+    if end <= start:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": "end_time must be after start_time"}
+        )
+    
+    try:
+        index = get_schedule_index(db, school_id)
+        with index.lock:
+            return index.free_teachers(start, end)
+    except Exception as e:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+
+# Book an exam for an enrolled student
+@app.post("/api/exams/book", response_model=Dict[str, Any], dependencies=[Depends(admit_write)])
+def book_exam(exam_data: dict = Body(...), db=Depends(get_db)):
+    try:
+        user_id = exam_data.get("user_id")
+        course_id = exam_data.get("course_id")
+        exam_date = exam_data.get("exam_date")
+        
+        if not user_id or not course_id or not exam_date:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Missing user_id, course_id or exam_date"}
+            )
+        
+        try:
+            user_id = int(user_id)
+            course_id = int(course_id)
+        except (TypeError, ValueError):
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Invalid user_id or course_id"}
+            )
+        
+        try:
+            exam_date = datetime.fromisoformat(exam_date)
+        except (TypeError, ValueError):
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Invalid exam_date"}
+            )
+        
+        enrollment_row = db.execute(
+            text("""
+                SELECT id FROM enrollments
+                WHERE user_id = :user_id AND course_id = :course_id
+            """),
+            {"user_id": user_id, "course_id": course_id}
+        ).fetchone()
+        
+        if not enrollment_row:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Student is not enrolled in this course"}
+            )
+        
+        booked_row = db.execute(
+            text("""
+                SELECT id FROM exams
+                WHERE user_id = :user_id AND course_id = :course_id AND status = 'scheduled'
+            """),
+            {"user_id": user_id, "course_id": course_id}
+        ).fetchone()
+        
+        if booked_row:
+            return JSONResponse(
+                status_code=status.HTTP_409_CONFLICT,
+                content={"message": "An exam is already booked for this course", "exam_id": booked_row[0]}
+            )
+        
+        # Start a transaction
+        conn = db.connection()
+        
+        db.execute(
+            text("""
+                INSERT INTO exams (user_id, course_id, exam_date, status)
+                VALUES (:user_id, :course_id, :exam_date, 'scheduled')
+            """),
+            {"user_id": user_id, "course_id": course_id, "exam_date": exam_date}
+        )
+        
+        exam_id = conn.insert_id()
+        
+        db.commit()
+        
+        return {
+            "message": "Exam booked successfully",
+            "exam_id": exam_id
+        }
+    
+    except Exception as e:
+        db.rollback()
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": f"Database error: {str(e)}"}
+        )
+
+# Record exam results for a whole cohort
+@app.post("/api/exams/results", response_model=Dict[str, Any], dependencies=[Depends(admit_write)])
+def record_exam_results(results_data: dict = Body(...), db=Depends(get_db)):
+    try:
+        entries = results_data.get("results")
+        
+        try:
+            pass_score = float(results_data.get("pass_score", EXAM_PASS_SCORE))
+            if not math.isfinite(pass_score):
+                raise ValueError(pass_score)
+        except (TypeError, ValueError):
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Invalid pass_score"}
+            )
+        
+        if not entries or not isinstance(entries, list):
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Missing results"}
+            )
+        
+        if len(entries) > EXAM_RESULTS_MAX_BATCH:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": f"At most {EXAM_RESULTS_MAX_BATCH} results can be recorded per request"}
+            )
+        
+        # Later entries for the same exam win
+        scores = {}
+        invalid = []
+        for position, entry in enumerate(entries):
+            try:
+                score = float(entry["score"])
+                if not math.isfinite(score):
+                    raise ValueError(score)
+                scores[int(entry["exam_id"])] = score
+            except (KeyError, TypeError, ValueError):
+                invalid.append(position)
+        
+        if invalid:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Invalid results entries", "invalid_entries": invalid}
+            )
+        
+        existing_result = db.execute(
+            text("SELECT id FROM exams WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"ids": list(scores)}
+        )
+        existing_ids = {row[0] for row in existing_result}
+        
+        results = [
+            (exam_id, score, "passed" if score >= pass_score else "failed")
+            for exam_id, score in scores.items() if exam_id in existing_ids
+        ]
+        
+        if results:
+            apply_exam_results(db, results)
+        
+        db.commit()
+        
+        return {
+            "message": "Exam results recorded successfully",
+            "recorded": len(results),
+            "passed": sum(1 for result in results if result[2] == "passed"),
+            "failed": sum(1 for result in results if result[2] == "failed"),
+            "missing_exam_ids": [exam_id for exam_id in scores if exam_id not in existing_ids]
         }
     
     except Exception as e:
+        db.rollback()
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"message": f"Database error: {str(e)}"}
         )
 
+# Database warm-up
+# The process starts serving immediately; the database is warmed up in the
+# background, retrying with exponential backoff, and /api/health/ready keeps
+# reporting unavailable until it is reachable. Creating this service's
+# tables is attempted once the database is reachable; a failure there (e.g.
+# missing CREATE rights) is reported by the readiness probe but does not
+# hold traffic back, since the pre-existing routes do not need those tables.
+DB_WARMUP_MAX_BACKOFF_SECONDS = float(os.environ.get("DB_WARMUP_MAX_BACKOFF_SECONDS", "30"))
+
+_db_ready = threading.Event()
+_shutting_down = threading.Event()
+_schema_error = None
+
+def warm_up_database():
+    global _schema_error
+    
+    backoff = 0.25
+    while not _shutting_down.is_set():
+        try:
+            # Test the database connection
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            break
+        except Exception as e:
+            print(f"Failed to connect to the database, retrying in {backoff:.2f}s: {e}")
+            _shutting_down.wait(backoff)
+            backoff = min(backoff * 2, DB_WARMUP_MAX_BACKOFF_SECONDS)
+    else:
+        return
+    print("Connected to MySQL database!")
+    
+    try:
+        ensure_schema()
+    except Exception as e:
+        _schema_error = str(e)
+        print(f"Failed to create service tables: {e}")
+    _db_ready.set()
+
 # Startup event to connect to the database
 @app.on_event("startup")
 def startup_db_client():
-    try:
-        # Test the database connection
-        with engine.connect() as connection:
-            connection.execute(text("SELECT 1"))
-        print("Connected to MySQL database!")
-    except Exception as e:
-        print(f"Failed to connect to the database: {e}")
-        raise
+    threading.Thread(target=warm_up_database, name="db-warm-up", daemon=True).start()
+    if replica_router is not None:
+        threading.Thread(target=replica_router.run_health_checks, name="replica-health", daemon=True).start()
+    if ARCHIVE_INTERVAL_HOURS > 0:
+        threading.Thread(target=archival_schedule, name="archival-schedule", daemon=True).start()
 
 # Shutdown event to close the database connection
 @app.on_event("shutdown")
 def shutdown_db_client():
-    SessionLocal().close_all()
+    _shutting_down.set()
+    engine.dispose()
+    if replica_router is not None:
+        replica_router.dispose()
     print("Database connection closed.")
+
+# Management commands
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Driving school backend management commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("archive", help="move past sessions and old reviews to the archive tables")
+    args = parser.parse_args()
+    
+    if args.command == "archive":
+        ensure_schema()
+        moved = run_archival()
+        if moved is None:
+            print("Archival already running elsewhere")
+            raise SystemExit(1)
+        print(f"Archived {moved['sessions']} sessions and {moved['reviews']} reviews")
@@ -4,18 +4,49 @@ set -e
 # Start the FastAPI backend
 cd /backend || { echo "Backend directory not found"; exit 1; }
 
-echo "Starting FastAPI backend"
+# SERVER_MODE=production (default) runs WEB_CONCURRENCY worker processes,
+# SERVER_MODE=development runs a single reloading process
+SERVER_MODE=${SERVER_MODE:-production}
+# By default one worker per CPU, capped so that every worker still gets two
+# of the DB_MAX_CONNECTIONS database connections
+DB_MAX_CONNECTIONS=${DB_MAX_CONNECTIONS:-40}
+if [ -z "$WEB_CONCURRENCY" ]; then
+    WEB_CONCURRENCY=$(nproc 2>/dev/null || echo 1)
+    MAX_WORKERS=$((DB_MAX_CONNECTIONS / 2))
+    if [ "$WEB_CONCURRENCY" -gt "$MAX_WORKERS" ]; then
+        WEB_CONCURRENCY=$MAX_WORKERS
+    fi
+fi
+READY_TIMEOUT=${READY_TIMEOUT:-60}
+# Workers share read-your-writes markers through a local SQLite file
+READ_YOUR_WRITES_STORE=${READ_YOUR_WRITES_STORE:-/tmp/read_your_writes.sqlite3}
+export WEB_CONCURRENCY DB_MAX_CONNECTIONS READ_YOUR_WRITES_STORE
+
+echo "Starting FastAPI backend ($SERVER_MODE mode)"
 # Start Uvicorn with proper host binding
-uvicorn server:app --host 0.0.0.0 --port 8001 &
+if [ "$SERVER_MODE" = "development" ]; then
+    WEB_CONCURRENCY=1 uvicorn server:app --host 0.0.0.0 --port 8001 --reload &
+else
+    echo "Using $WEB_CONCURRENCY worker processes"
+    uvicorn server:app --host 0.0.0.0 --port 8001 --workers "$WEB_CONCURRENCY" &
+fi
 BACKEND_PID=$!
 
-echo "Waiting for backend to start..."
-sleep 30
-
-if ! kill -0 $BACKEND_PID 2>/dev/null; then
-    echo "Backend failed to start at initialization, exiting"
-    exit 1
-fi
+echo "Waiting for backend to become ready..."
+START_TIME=$(date +%s)
+until wget -q -O /dev/null http://127.0.0.1:8001/api/health/ready 2>/dev/null; do
+    if ! kill -0 $BACKEND_PID 2>/dev/null; then
+        echo "Backend failed to start at initialization, exiting"
+        exit 1
+    fi
+    if [ $(( $(date +%s) - START_TIME )) -ge "$READY_TIMEOUT" ]; then
+        echo "Backend not ready after ${READY_TIMEOUT}s, exiting"
+        kill $BACKEND_PID
+        exit 1
+    fi
+    sleep 0.5
+done
+echo "Backend is ready"
 
 # Start Nginx
 nginx -g 'daemon off;' &
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Measure the cold start of the backend and check it against a budget.
+
+Runs `python -X importtime -c "import server"` in a fresh interpreter from the
+backend directory, prints the slowest imports made by the server module
+and exits non-zero
+when the total import time exceeds IMPORT_BUDGET_MS.
+
+Usage: python scripts/import_budget.py [--budget-ms 1000] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+def measure_imports():
+    """Return (wall_ms, [(cumulative_us, self_us, module, depth)])."""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if completed.returncode != 0:
+        sys.stderr.write(completed.stderr)
+        sys.exit(completed.returncode)
+
+    entries = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        depth = (len(module) - len(module.lstrip())) // 2
+        entries.append((int(cumulative_us), int(self_us), module.strip(), depth))
+    return wall_ms, entries
+
+
+def server_imports(entries):
+    """Return the entries imported directly by the server module.
+
+    -X importtime lists a module after everything it imported, so the
+    children of `server` are the depth-1 entries right before it.
+    """
+    children = []
+    for entry in entries:
+        depth = entry[3]
+        if depth == 1:
+            children.append(entry)
+        elif depth == 0:
+            if entry[2] == "server":
+                return children
+            children = []
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=float(os.environ.get("IMPORT_BUDGET_MS", "1000")))
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    wall_ms, entries = measure_imports()
+    total_ms = sum(entry[1] for entry in entries) / 1000
+
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative_us, self_us, module, _ in sorted(server_imports(entries), reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {module}")
+
+    print()
+    print(f"Total import time: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    print(f"Process start to 'import server' done: {wall_ms:.1f} ms")
+
+    if total_ms > args.budget_ms:
+        print("Import time budget exceeded")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+import threading
+from datetime import date, datetime, time, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import server
+
+
+class RecordingSession:
+    """Stand-in for a database session that records executed statements."""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.statements = []
+        self.committed = False
+
+    def execute(self, statement, params=None):
+        self.statements.append((" ".join(str(statement).split()), params))
+        return iter(self.rows)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+def request_with_headers(headers, client=("203.0.113.7", 50000), path_params=None):
+    return Request({
+        "type": "http",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "client": client,
+        "path_params": path_params or {},
+    })
+
+
+@pytest.fixture
+def client_with_db():
+    def client(db):
+        server.app.dependency_overrides[server.get_db] = lambda: db
+        return TestClient(server.app)
+
+    yield client
+    server.app.dependency_overrides.clear()
+
+
+# Teacher scheduling
+
+@pytest.fixture
+def schedule_index():
+    index = server.TeacherScheduleIndex(1, {7: {"id": 7}, 8: {"id": 8}})
+    day = date(2030, 1, 1)
+    index.add(7, *server.session_interval(day, timedelta(hours=9), timedelta(hours=10)), 1)
+    index.add(7, *server.session_interval(day, timedelta(hours=11), timedelta(hours=12)), 2)
+    return index
+
+
+def slot(start, end):
+    return server.session_interval(date(2030, 1, 1), start, end)
+
+
+def test_find_conflict_detects_overlap(schedule_index):
+    assert schedule_index.find_conflict(7, *slot(time(9, 30), time(10, 30))) == 1
+    assert schedule_index.find_conflict(7, *slot(time(11, 59), time(13))) == 2
+
+
+def test_find_conflict_allows_adjacent_slots(schedule_index):
+    assert schedule_index.find_conflict(7, *slot(time(10), time(11))) is None
+    assert schedule_index.find_conflict(7, *slot(time(12), time(13))) is None
+
+
+def test_find_conflict_ignores_the_session_being_reassigned(schedule_index):
+    assert schedule_index.find_conflict(7, *slot(time(9, 30), time(10, 30)), ignore_session_id=1) is None
+
+
+def test_free_teachers(schedule_index):
+    assert schedule_index.free_teachers(*slot(time(9, 30), time(10))) == [{"id": 8}]
+    assert len(schedule_index.free_teachers(*slot(time(13), time(14)))) == 2
+
+
+def test_remove_frees_the_slot(schedule_index):
+    schedule_index.remove(1)
+    assert schedule_index.find_conflict(7, *slot(time(9), time(10))) is None
+    assert schedule_index.starts[7] == [datetime(2030, 1, 1, 11)]
+
+
+# Course progression
+
+def test_build_progression_opens_next_stage_once_previous_is_completed():
+    progression = server.build_progression([
+        (1, "Theory", "theory", 1, True, True),
+        (2, "Parking", "parking", 2, True, False),
+        (3, "Road", "road", 3, False, False),
+    ])
+    assert progression["current_stage"] == 1
+    assert progression["completed_courses"] == [1]
+    assert [c["id"] for c in progression["eligible_courses"]] == [2]
+    assert progression["next_course"]["id"] == 2
+    assert progression["next_course"]["enrolled"] is True
+
+
+def test_build_progression_keeps_stage_open_until_all_its_courses_are_completed():
+    progression = server.build_progression([
+        (1, "Theory A", "theory", 1, True, True),
+        (2, "Theory B", "theory", 1, False, None),
+        (3, "Road", "road", 2, False, None),
+    ])
+    assert progression["current_stage"] == 0
+    assert [c["id"] for c in progression["eligible_courses"]] == [2]
+
+
+def test_build_progression_when_everything_is_completed():
+    progression = server.build_progression([(1, "Theory", "theory", 1, True, True)])
+    assert progression["current_stage"] == 1
+    assert progression["eligible_courses"] == []
+    assert progression["next_course"] is None
+
+
+# Exams
+
+def test_apply_exam_results_sends_one_update_per_chunk(monkeypatch):
+    monkeypatch.setattr(server, "EXAM_RESULTS_CHUNK_SIZE", 2)
+    db = RecordingSession()
+    server.apply_exam_results(db, [(1, 80.0, "passed"), (2, 20.0, "failed"), (3, 50.0, "passed")])
+
+    updates = [params for statement, params in db.statements if statement.startswith("UPDATE exams")]
+    assert [params["ids"] for params in updates] == [[1, 2], [3]]
+    assert updates[0]["score_1"] == 20.0 and updates[0]["status_1"] == "failed"
+    assert len(db.statements) == 4
+
+
+def test_book_exam_rejects_non_numeric_ids(client_with_db):
+    db = RecordingSession()
+    response = client_with_db(db).post(
+        "/api/exams/book", json={"user_id": "abc", "course_id": 1, "exam_date": "2030-01-01T09:00:00"}
+    )
+    assert response.status_code == 400
+    assert db.statements == []
+
+
+def test_record_exam_results_rejects_non_finite_scores(client_with_db):
+    db = RecordingSession()
+    client = client_with_db(db)
+    response = client.post("/api/exams/results", json={"results": [{"exam_id": 1, "score": "nan"}]})
+    assert response.status_code == 400
+    assert response.json()["invalid_entries"] == [0]
+    response = client.post("/api/exams/results", json={"results": [{"exam_id": 1, "score": 60}], "pass_score": "inf"})
+    assert response.status_code == 400
+    assert db.statements == []
+
+
+def test_record_exam_results_skips_unknown_exams(client_with_db):
+    db = RecordingSession(rows=[(1,)])
+    response = client_with_db(db).post(
+        "/api/exams/results", json={"results": [{"exam_id": 1, "score": 60}, {"exam_id": 2, "score": 10}]}
+    )
+    assert response.json()["recorded"] == 1
+    assert response.json()["missing_exam_ids"] == [2]
+    assert db.statements[0][1] == {"ids": [1, 2]}
+    assert db.committed
+
+
+# Calendar feed
+
+def test_ics_line_folds_long_lines_without_splitting_characters():
+    line = server.ics_line("SUMMARY:" + "é" * 60)
+    parts = line[:-2].split("\r\n ")
+    assert all(len(part.encode()) <= 75 for part in parts)
+    assert "".join(parts) == "SUMMARY:" + "é" * 60
+
+
+def test_ics_escape():
+    assert server.ics_escape("a,b;c\\d\ne") == "a\\,b\\;c\\\\d\\ne"
+
+
+def test_is_calendar_unchanged():
+    etag = '"abc"'
+    assert server.is_calendar_unchanged(request_with_headers({"If-None-Match": '"abc"'}), etag)
+    assert server.is_calendar_unchanged(request_with_headers({"If-None-Match": '"x", W/"abc"'}), etag)
+    assert server.is_calendar_unchanged(request_with_headers({"If-None-Match": "*"}), etag)
+    assert not server.is_calendar_unchanged(request_with_headers({"If-None-Match": '"other"'}), etag)
+    assert not server.is_calendar_unchanged(
+        request_with_headers({"If-Modified-Since": "Wed, 01 Jan 2100 00:00:00 GMT"}), etag
+    )
+
+
+# Read replicas
+
+def test_recent_writers_expire_and_are_pruned_on_write():
+    writers = server.RecentWriters(ttl_seconds=60)
+    writers.mark(["client:a", "user:1"])
+    assert writers.any_recent(["user:1"])
+    assert not writers.any_recent(["user:2"])
+
+    writers.ttl = 0
+    writers.mark(["client:b"])
+    assert not writers.any_recent(["client:b"])
+    writers.mark(["client:c"])
+    assert "client:b" not in writers.expires
+
+
+def test_shared_recent_writers_are_visible_to_other_workers(tmp_path):
+    path = str(tmp_path / "writers.sqlite3")
+    first = server.SharedRecentWriters(60, path)
+    second = server.SharedRecentWriters(60, path)
+    first.mark(["user:1"])
+    assert second.any_recent(["client:x", "user:1"])
+    assert not second.any_recent(["user:2"])
+
+    first.ttl = 0
+    first.mark(["user:2"])
+    second.mark(["user:3"])
+    assert second.connection.execute("SELECT key FROM recent_writes WHERE key = 'user:2'").fetchone() is None
+
+
+def test_read_sessionmaker_uses_primary_after_a_write(monkeypatch):
+    class Router:
+        def pick_sessionmaker(self):
+            return "replica"
+
+    monkeypatch.setattr(server, "replica_router", Router())
+    monkeypatch.setattr(server, "recent_writers", server.RecentWriters(60))
+    reader = request_with_headers({}, path_params={"user_id": "5"})
+    assert server.read_sessionmaker(reader) == "replica"
+
+    server.mark_recent_write(request_with_headers({}, client=("198.51.100.1", 1)), user_id=5)
+    assert server.wrote_recently(reader)
+    assert server.read_sessionmaker(reader) is server.SessionLocal
+
+
+# Batched reads
+
+def test_plan_batch_merges_operations_into_one_loader_per_query():
+    loaders, ops = server.plan_batch([
+        {"op": "states"},
+        {"op": "school_details", "school_ids": [1, 2]},
+        {"op": "school_details", "school_id": 3},
+        {"op": "course_sessions", "school_id": 1, "course_ids": [4, 5]},
+        {"op": "course_sessions", "school_id": 1, "course_id": 6},
+        {"op": "schools_by_state", "state_id": 9, "fields": ["name"]},
+    ])
+    assert set(loaders) == {
+        "states",
+        "school_details",
+        ("course_sessions", 1),
+        ("schools_by_state", ("id", "name")),
+    }
+    assert all("error" not in op for op in ops)
+
+
+def test_plan_batch_reports_invalid_operations_per_operation():
+    _, ops = server.plan_batch([
+        {"op": "bogus"},
+        {"op": "school_details"},
+        {"op": "schools_by_state", "state_id": 1, "fields": 5},
+        {"op": "school_details", "school_ids": list(range(server.BATCH_MAX_IDS + 1))},
+    ])
+    assert all("error" in op for op in ops)
+
+
+def test_batch_result_picks_requested_ids():
+    _, ops = server.plan_batch([{"id": "a", "op": "school_details", "school_ids": [1, 2]}])
+    result = server.batch_result(ops[0], {"school_details": {1: {"id": 1}}})
+    assert result == {"id": "a", "op": "school_details", "status": 200, "data": {"1": {"id": 1}, "2": None}}
+
+
+# Sparse fieldsets and compression
+
+def test_parse_school_fields():
+    assert server.parse_school_fields(None) is None
+    assert server.parse_school_fields("rating, name") == ("id", "name", "rating")
+    assert server.parse_school_fields(["images"]) == ("id", "images")
+
+
+def test_parse_school_fields_rejects_unknown_and_invalid_fields():
+    with pytest.raises(ValueError):
+        server.parse_school_fields("name,password_hash")
+    with pytest.raises(ValueError):
+        server.parse_school_fields({"name": True})
+
+
+def test_negotiate_encoding(monkeypatch):
+    monkeypatch.setattr(server, "brotli", None)
+    assert server.negotiate_encoding("gzip, deflate, br") == "gzip"
+    assert server.negotiate_encoding("*") == "gzip"
+    assert server.negotiate_encoding("identity") is None
+    assert server.negotiate_encoding("gzip;q=0") is None
+
+    monkeypatch.setattr(server, "brotli", object())
+    assert server.negotiate_encoding("gzip, br") in ("gzip", "br")
+    assert server.negotiate_encoding("gzip;q=0.5, br") == "br"
+
+
+# Write admission control
+
+def test_token_buckets_allow_a_burst_then_ask_to_wait():
+    buckets = server.TokenBuckets(rate_per_second=1, burst=2)
+    assert buckets.take("client:a") == 0
+    assert buckets.take("client:a") == 0
+    assert 0 < buckets.take("client:a") <= 1
+    assert buckets.take("client:b") == 0
+
+
+def test_token_buckets_drop_refilled_buckets(monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_SWEEP_SECONDS", 0)
+    buckets = server.TokenBuckets(rate_per_second=1, burst=2)
+    buckets.take("client:a")
+    buckets.buckets["client:b"] = (0, 0)
+    buckets.take("client:c")
+    assert "client:a" in buckets.buckets
+    assert "client:b" not in buckets.buckets
+    assert "client:c" in buckets.buckets
+
+
+def test_shared_token_buckets_are_shared_and_swept(tmp_path, monkeypatch):
+    path = str(tmp_path / "buckets.sqlite3")
+    first = server.SharedTokenBuckets(1, 1, path)
+    second = server.SharedTokenBuckets(1, 1, path)
+    assert first.take("client:a") == 0
+    assert second.take("client:a") > 0
+
+    monkeypatch.setattr(server, "RATE_LIMIT_SWEEP_SECONDS", 0)
+    second.connection.execute("UPDATE token_buckets SET updated_at = 0")
+    second.take("client:b")
+    keys = [row[0] for row in second.connection.execute("SELECT key FROM token_buckets")]
+    assert keys == ["client:b"]
+
+
+def test_writes_are_rate_limited_with_retry_after(client_with_db, monkeypatch):
+    monkeypatch.setattr(server, "rate_limiter", server.TokenBuckets(rate_per_second=0.5, burst=1))
+    client = client_with_db(RecordingSession())
+    body = {"results": [{"exam_id": 1, "score": 60}]}
+    assert client.post("/api/exams/results", json=body).status_code == 200
+    response = client.post("/api/exams/results", json=body)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+
+def test_writes_are_shed_when_the_write_pool_is_saturated(client_with_db, monkeypatch):
+    monkeypatch.setattr(server, "rate_limiter", server.TokenBuckets(rate_per_second=1, burst=100))
+    monkeypatch.setattr(server, "write_connection_slots", lambda: 1)
+    monkeypatch.setattr(server, "WRITE_QUEUE_THRESHOLD", 0)
+
+    entered, release = threading.Event(), threading.Event()
+
+    class BlockingSession(RecordingSession):
+        def execute(self, statement, params=None):
+            entered.set()
+            release.wait(5)
+            return super().execute(statement, params)
+
+    client = client_with_db(BlockingSession())
+    body = {"results": [{"exam_id": 1, "score": 60}]}
+    responses = []
+    writer = threading.Thread(target=lambda: responses.append(client.post("/api/exams/results", json=body)))
+    writer.start()
+    try:
+        assert entered.wait(5)
+        response = client.post("/api/exams/results", json=body)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(server.WRITE_RETRY_AFTER_SECONDS)
+    finally:
+        release.set()
+        writer.join(5)
+    assert responses[0].status_code == 200
+    assert server._writes_in_flight == 0
+
+
+# Data retention
+
+class ArchivalResult:
+    def __init__(self, rows=(), rowcount=0):
+        self.rows = list(rows)
+        self.rowcount = rowcount
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def scalar(self):
+        return 1
+
+
+class ArchivalConnection:
+    """Stand-in for the archival connection; DELETEs remove `deleted` rows."""
+
+    def __init__(self, session_ids, deleted):
+        self.session_ids = session_ids
+        self.deleted = deleted
+        self.log = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, params=None):
+        sql = " ".join(str(statement).split())
+        self.log.append(sql.split("(")[0] if "LOCK" in sql else sql.split(" ")[0])
+        if sql.startswith("SELECT id FROM course_sessions"):
+            return ArchivalResult(rows=[(session_id,) for session_id in self.session_ids])
+        if sql.startswith("DELETE"):
+            return ArchivalResult(rowcount=self.deleted)
+        return ArchivalResult(rowcount=len(params["ids"]) if params and "ids" in params else 0)
+
+    def commit(self):
+        self.log.append("COMMIT")
+
+    def rollback(self):
+        self.log.append("ROLLBACK")
+
+
+def test_move_rows_fails_when_the_delete_does_not_match_the_copy():
+    connection = ArchivalConnection([], deleted=1)
+    server.move_rows(connection, "reviews", "id", [4])
+    connection.deleted = 0
+    with pytest.raises(RuntimeError):
+        server.move_rows(connection, "reviews", "id", [4])
+
+
+def test_run_archival_rolls_back_a_batch_whose_counts_differ(monkeypatch):
+    connection = ArchivalConnection([1, 2], deleted=1)
+    monkeypatch.setattr(server, "engine", type("Engine", (), {"connect": lambda self: connection})())
+    with pytest.raises(RuntimeError):
+        server.run_archival()
+    assert connection.log[-3:] == ["ROLLBACK", "SELECT RELEASE_LOCK", "COMMIT"]
+    assert connection.log.count("COMMIT") == 2
+
+
+# Profiling
+
+def test_statement_fingerprint_ignores_parameters():
+    first, first_hash = server.statement_fingerprint(
+        "SELECT id FROM x WHERE a = %(a)s AND b IN (%(ids_1)s, %(ids_2)s) AND c = 'it''s' LIMIT 5"
+    )
+    second, second_hash = server.statement_fingerprint(
+        "SELECT id FROM x   WHERE a = %(a)s AND b IN (%(ids_1)s) AND c = 'other' LIMIT 10"
+    )
+    assert first == "SELECT id FROM x WHERE a = ? AND b IN (?+) AND c = ? LIMIT ?"
+    assert first == second
+    assert first_hash == second_hash
+
+
+def test_statement_fingerprint_keeps_identifiers():
+    normalized, _ = server.statement_fingerprint("SELECT idx_1 FROM t2")
+    assert normalized == "SELECT idx_1 FROM t2"